@@ -45,7 +45,8 @@ cities in the United States.
 # 4) Run the automatic annealer which will attempt to choose reasonable values
 # for maximum and minimum temperatures and then anneal for the allotted time.
 
-import copy, math, random, sys, time
+import copy, json, math, os, random, sys, time
+from multiprocessing import Process, Pipe
 
 def round_figures(x, n):
 	"""Returns x rounded to n significant figures."""
@@ -63,11 +64,176 @@ class Annealer:
 	energy and make moves on a state.  The temperature schedule for
 	annealing may be provided manually or estimated automatically.
 	"""
-	def __init__(self, energy, move):
-		self.energy = energy  # function to calculate energy of a state
-		self.move = move      # function to make a random change to a state
+	def __init__(self, energy, move, undo=None, snapshot=None, restore=None,
+		checkpoint=None, interval=60.0, bias=None, sweep=None, propose=None, commit=None,
+		patience=0.0, done=None, metrics=None, tag=None):
+		"""Keyword arguments:
+		energy -- function to calculate energy of a state
+		move -- function to make a random change to a state
+		undo -- function to revert a move (optional, see below)
+		snapshot -- function to make a compact copy of a state (optional)
+		restore -- function to return a state to a snapshot (optional)
+		checkpoint -- filename for checkpoints of anneal() (optional)
+		interval -- seconds between checkpoints
+		bias -- function to give the Hastings ratio of a move (optional)
+		sweep -- function to try many moves at one temperature (optional)
+		propose -- function to choose a move without making it (optional)
+		commit -- function to make a move from propose() (optional)
+		patience -- fraction of steps without improvement before stopping
+		done -- function to tell when a state can improve no more (optional)
+		metrics -- function to record measurements as they are made (optional)
+		tag -- value saved with checkpoints that must match to resume (optional)
+		
+		When undo is given, move(state) must return a token describing the
+		change it made, and undo(state, token) must revert that change and
+		return the state and a new token that would redo it.  Rejected moves
+		then cost no more than the move itself, instead of a copy of the
+		entire state.  Without undo, the whole state is copied before each
+		move and a rejected move is reverted by swapping the copy back in.
+		
+		snapshot(state) and restore(state, snapshot) are used to remember
+		the best state found, which is only copied when the annealer is
+		about to leave it.  They default to a deep copy of the state.
+		
+		With a checkpoint filename, anneal() writes the current and best
+		snapshots, the schedule and the position in it, and the random
+		number generator state to that file as JSON every interval seconds
+		and when it finishes, so snapshots must be lists, numbers and the
+		like.  Pass the loaded checkpoint to anneal() to carry on from it.
+		A checkpoint saved with a different tag, such as a digest of a
+		state that has since changed shape, is not loaded.
+		
+		Moves are assumed to be as likely as the moves that would reverse
+		them.  When they are not, bias(state, token) must return the chance
+		of proposing the reverse of the move described by token over the
+		chance of proposing the move itself, and acceptance is scaled by it
+		to keep the Metropolis algorithm sampling the right distribution.
+		
+		When sweep is given, sweep(state, T) must try a move of every part
+		of the state at temperature T, accepting or rejecting each by the
+		Metropolis criterion, and return the state and the numbers of
+		moves tried and accepted.  auto() then anneals with sweeps().
+		
+		When propose and commit are given, they are used instead of move
+		and undo, so a rejected move costs only working out its change in
+		energy.  propose(state) must return a description of a random move
+		along with its change in energy and Hastings ratio, and commit(state,
+		proposal) must make the move and return the state and a proposal
+		to reverse it.
+		
+		Once past the middle of the schedule, anneal() and sweeps() stop
+		early when the best energy has not improved by more than a
+		thousandth for patience of the steps, or for half that when
+		done(state) also returns true.
+		
+		When metrics is given, metrics(event, values) is called with a
+		dictionary of values: "calibrate" when calibrate() or the search
+		for temperatures is done, "progress" at every update printed while
+		annealing, with moves per second since the update before, and
+		"anneal" when annealing is over, with its time and best energy."""
+		self.energy = energy
+		self.patience, self.done = patience, done
+		self.metrics = metrics
+		self.tag = tag
+		self.bias = bias
+		self.sweep = sweep
+		self.propose, self.commit = propose, commit
+		self.checkpoint = checkpoint
+		self.interval = interval
+		
+		if undo is None:
+			def copy_move(state):
+				token = copy.deepcopy(state)
+				move(state)
+				return token
+			
+			def copy_undo(state, token):
+				return token, state
+			
+			self.move, self.undo = copy_move, copy_undo
+		else:
+			self.move, self.undo = move, undo
+		
+		self.snapshot = snapshot or copy.deepcopy
+		self.restore = restore or (lambda state, snapshot: snapshot)
+	
+	def _leave_best(self, state, token):
+		"""Returns a snapshot of the state as it was before the move
+		described by token, leaving the state as it is now."""
+		revert = self.propose is not None and self.commit or self.undo
+		state, redo = revert(state, token)
+		snapshot = self.snapshot(state)
+		state, token = revert(state, redo)
+		return state, snapshot
+	
+	def _record(self, event, **values):
+		"""Passes measurements to the metrics function, if there is one."""
+		if self.metrics is not None:
+			self.metrics(event, values)
+	
+	def _reject(self, dE, T, bias=1.0):
+		"""Returns true if the Metropolis criterion rejects a move."""
+		if bias == 1.0:
+			return dE > 0.0 and math.exp(-dE/T) < random.random()
+		if bias <= 0.0:
+			return True
+		logBias = math.log(bias)
+		return dE > T * logBias and math.exp(logBias - dE/T) < random.random()
+	
+	def _settled(self, state, idle, step, steps):
+		"""Returns true if annealing can stop early, idle steps after the
+		best energy last improved.  Never with no patience."""
+		if self.patience <= 0.0:
+			return False
+		if step * 2 < steps or idle * 2 < self.patience * steps:
+			return False
+		if idle >= self.patience * steps:
+			return True
+		return self.done is not None and self.done(state)
 	
-	def anneal(self, state, Tmax, Tmin, steps, updates=0):
+	def _attempt(self, state, T, prevEnergy):
+		"""Tries a move at temperature T by the Metropolis criterion.
+		
+		Returns the state, its energy, the change in energy, a token for
+		_leave_best(), and whether the move was accepted."""
+		if self.propose is not None:
+			proposal, dE, bias = self.propose(state)
+			if self._reject(dE, T, bias):
+				return state, prevEnergy, dE, None, False
+			state, token = self.commit(state, proposal)
+			return state, self.energy(state), dE, token, True
+		
+		token = self.move(state)
+		E = self.energy(state)
+		dE = E - prevEnergy
+		bias = self.bias is None and 1.0 or self.bias(state, token)
+		if self._reject(dE, T, bias):
+			state, token = self.undo(state, token)
+			return state, prevEnergy, dE, token, False
+		return state, E, dE, token, True
+	
+	def load_checkpoint(self):
+		"""Returns the checkpoint written by an earlier anneal(), or None."""
+		if self.checkpoint is None or not os.path.exists(self.checkpoint):
+			return None
+		checkpoint = json.load(open(self.checkpoint))
+		if checkpoint.get('tag') != self.tag:
+			print 'Ignoring checkpoint %s, saved for a different state.' % self.checkpoint
+			return None
+		return checkpoint
+	
+	def _save_checkpoint(self, state, Tmax, Tmin, steps, step, T, bestEnergy, bestState):
+		"""Writes a checkpoint, replacing the last one in a single rename."""
+		checkpoint = {'Tmax': Tmax, 'Tmin': Tmin, 'steps': steps, 'step': step,
+			'T': T, 'state': self.snapshot(state), 'best energy': bestEnergy,
+			'best state': bestState, 'random': random.getstate(), 'tag': self.tag}
+		temporary = '%s.%d' % (self.checkpoint, os.getpid())
+		file = open(temporary, 'w')
+		json.dump(checkpoint, file)
+		file.close()
+		os.rename(temporary, self.checkpoint)
+	
+	def anneal(self, state, Tmax, Tmin, steps, updates=0, resume=None):
 		"""Minimizes the energy of a system by simulated annealing.
 		
 		Keyword arguments:
@@ -76,12 +242,23 @@ class Annealer:
 		Tmin -- minimum temperature (must be greater than zero)
 		steps -- the number of steps requested
 		updates -- the number of updates to print during annealing
+		resume -- a checkpoint from load_checkpoint() to carry on from,
+		          whose schedule replaces Tmax, Tmin and steps
 		
 		Returns the best state and energy found."""
 		
 		step = 0
 		start = time.time()
 		
+		if resume is not None:
+			Tmax, Tmin, steps, step = resume['Tmax'], resume['Tmin'], resume['steps'], resume['step']
+			state = self.restore(state, resume['state'])
+			version, internal, gauss = resume['random']
+			random.setstate((version, tuple(internal), gauss))
+		
+		first, saved = step, time.time()
+		last = [step, start]
+		
 		def update(T, E, acceptance, improvement):
 			"""Prints the current temperature, energy, acceptance rate,
 			improvement rate, elapsed time, and remaining time.
@@ -101,16 +278,21 @@ class Annealer:
 			are exhausted and moves that would increase the energy are no longer
 			thermally accessible."""
 			
-			elapsed = time.time() - start
-			if step == 0:
+			now = time.time()
+			elapsed = now - start
+			if acceptance is None:
 				print ' Temperature        Energy    Accept   Improve     Elapsed   Remaining'
 				print '%12.2f  %12.2f                      %s            ' % \
 					(T, E, time_string(elapsed) )
 			else:
-				remain = ( steps - step ) * ( elapsed / step )
+				remain = ( steps - step ) * ( elapsed / ( step - first ) )
 				print '%12.2f  %12.2f  %7.2f%%  %7.2f%%  %s  %s' % \
 					(T, E, 100.0*acceptance, 100.0*improvement,
 						time_string(elapsed), time_string(remain))
+			self._record('progress', method='anneal', step=step, steps=steps,
+				T=T, energy=E, acceptance=acceptance, improvement=improvement,
+				elapsed=elapsed, rate=(step - last[0]) / max(now - last[1], 1e-6))
+			last[:] = [step, now]
 		
 		# Precompute factor for exponential cooling from Tmax to Tmin
 		if Tmin <= 0.0:
@@ -118,49 +300,321 @@ class Annealer:
 			sys.exit()
 		Tfactor = -math.log( float(Tmax) / Tmin )
 		
-		# Note initial state
-		T = Tmax
+		# Note initial state; the best state is only copied once we leave it
+		T = Tmax * math.exp( Tfactor * step / steps )
 		E = self.energy(state)
-		prevState = copy.deepcopy(state)
 		prevEnergy = E
-		bestState = copy.deepcopy(state)
+		bestState, atBest = None, True
 		bestEnergy = E
 		trials, accepts, improves = 0, 0, 0
+		if resume is not None and resume['best energy'] < E:
+			bestState, atBest = resume['best state'], False
+			bestEnergy = resume['best energy']
+		improved, improvedEnergy = step, bestEnergy
+		checkWavelength = max(int(steps) // 100, 1)
 		if updates > 0:
 			updateWavelength = float(steps) / updates
 			update(T, E, None, None)
+		early = None
 		
 		# Attempt moves to new states
 		while step < steps:
 			step += 1
 			T = Tmax * math.exp( Tfactor * step / steps )
-			self.move(state)
-			E = self.energy(state)
-			dE = E - prevEnergy
+			state, E, dE, token, accepted = self._attempt(state, T, prevEnergy)
 			trials += 1
-			if dE > 0.0 and math.exp(-dE/T) < random.random():
-				# Restore previous state
-				state = copy.deepcopy(prevState)
-				E = prevEnergy
-			else:
-				# Accept new state and compare to best state
+			if accepted:
+				# Compare new state to best state
 				accepts += 1
 				if dE < 0.0:
 					improves += 1
-				prevState = copy.deepcopy(state)
-				prevEnergy = E
 				if E < bestEnergy:
-					bestState = copy.deepcopy(state)
-					bestEnergy = E
+					bestEnergy, atBest = E, True
+					if improvedEnergy - E > 1e-3 * max(abs(improvedEnergy), 1.0):
+						improved, improvedEnergy = step, E
+				elif atBest and E > bestEnergy:
+					state, bestState = self._leave_best(state, token)
+					atBest = False
+				prevEnergy = E
 			if updates > 1:
 				if step // updateWavelength > (step-1) // updateWavelength:
 					update(T, E, float(accepts)/trials, float(improves)/trials)
 					trials, accepts, improves = 0, 0, 0
+			if step % checkWavelength == 0 and self._settled(state, step - improved, step, steps):
+				print 'Settled at step %i of %i, stopping early.' % (step, steps)
+				step, early = steps, step
+				break
+			if self.checkpoint and step % 100 == 0 and time.time() - saved > self.interval:
+				if atBest:
+					bestState = self.snapshot(state)
+				self._save_checkpoint(state, Tmax, Tmin, steps, step, T, bestEnergy, bestState)
+				saved = time.time()
 		
 		# Return best state and energy
-		return bestState, bestEnergy
+		if not atBest:
+			state = self.restore(state, bestState)
+		if self.checkpoint:
+			self._save_checkpoint(state, Tmax, Tmin, steps, step, T, bestEnergy, self.snapshot(state))
+		elapsed, made = time.time() - start, (early or step) - first
+		self._record('anneal', method='anneal', Tmax=Tmax, Tmin=Tmin, steps=steps,
+			made=made, early=early is not None, seconds=elapsed,
+			rate=made / max(elapsed, 1e-6), energy=bestEnergy)
+		return state, bestEnergy
+	
+	def sweeps(self, state, Tmax, Tmin, steps, updates=0):
+		"""Minimizes the energy of a system by simulated annealing in sweeps
+		of moves, cooling between sweeps instead of between moves.
+		
+		Keyword arguments are as for anneal(), with steps counting every
+		move tried in a sweep.
+		
+		Returns the best state and energy found."""
+		
+		step = 0
+		start = time.time()
+		
+		if Tmin <= 0.0:
+			print 'Exponential cooling requires a minimum temperature greater than zero.'
+			sys.exit()
+		Tfactor = -math.log( float(Tmax) / Tmin )
+		
+		T = Tmax
+		E = self.energy(state)
+		bestState, bestEnergy = self.snapshot(state), E
+		improved, improvedEnergy = step, E
+		
+		if updates > 0:
+			print ' Temperature        Energy    Accept      Sweeps     Elapsed   Remaining'
+			print '%12.2f  %12.2f                         %s            ' % \
+				(T, E, time_string(time.time() - start))
+			updateWavelength = float(steps) / updates
+		
+		sweeps, trials, accepts = 0, 0, 0
+		last, early = 0.0, False
+		while step < steps:
+			T = Tmax * math.exp( Tfactor * step / steps )
+			state, tried, accepted = self.sweep(state, T)
+			E = self.energy(state)
+			if E < bestEnergy:
+				bestState, bestEnergy = self.snapshot(state), E
+				if improvedEnergy - E > 1e-3 * max(abs(improvedEnergy), 1.0):
+					improved, improvedEnergy = step, E
+			sweeps, trials, accepts = sweeps + 1, trials + tried, accepts + accepted
+			step += max(tried, 1)
+			if updates > 0 and (step // updateWavelength > (step - max(tried, 1)) // updateWavelength or step >= steps):
+				elapsed = time.time() - start
+				remain = max(steps - step, 0) * ( elapsed / step )
+				print '%12.2f  %12.2f  %7.2f%%  %10i  %s  %s' % \
+					(T, E, 100.0*accepts/max(trials, 1), sweeps,
+						time_string(elapsed), time_string(remain))
+				self._record('progress', method='sweeps', step=step, steps=steps,
+					T=T, energy=E, acceptance=float(accepts)/max(trials, 1), sweeps=sweeps,
+					elapsed=elapsed, rate=trials / max(elapsed - last, 1e-6))
+				trials, accepts, last = 0, 0, elapsed
+			if self._settled(state, step - improved, step, steps):
+				print 'Settled at step %i of %i, stopping early.' % (step, steps)
+				early = True
+				break
+		
+		if bestEnergy < E:
+			state = self.restore(state, bestState)
+		elapsed = time.time() - start
+		self._record('anneal', method='sweeps', Tmax=Tmax, Tmin=Tmin, steps=steps,
+			made=step, early=early, seconds=elapsed,
+			rate=step / max(elapsed, 1e-6), energy=bestEnergy)
+		return state, bestEnergy
+	
+	def _replica(self, state, connection):
+		"""Runs in a worker process, annealing one replica of the state at
+		whatever constant temperature it is sent until told to stop.
+		
+		Receives (T, steps) and replies with the current energy, receives
+		'best' and replies with the best energy and a snapshot of the best
+		state, and receives None to stop."""
+		
+		# A forked process starts with the random state of its parent, so
+		# seed here rather than count on whatever started the process to
+		random.seed()
+		
+		E = self.energy(state)
+		bestState, atBest = None, True
+		bestEnergy = E
+		
+		while True:
+			message = connection.recv()
+			
+			if message is None:
+				break
+			
+			if message == 'best':
+				if atBest:
+					bestState = self.snapshot(state)
+				connection.send((bestEnergy, bestState))
+				continue
+			
+			T, steps = message
+			prevEnergy = E
+			for step in range(steps):
+				state, E, dE, token, accepted = self._attempt(state, T, prevEnergy)
+				if accepted:
+					if E < bestEnergy:
+						bestEnergy, atBest = E, True
+					elif atBest and E > bestEnergy:
+						state, bestState = self._leave_best(state, token)
+						atBest = False
+					prevEnergy = E
+			connection.send(E)
+		
+		connection.close()
+	
+	def temper(self, state, Tmax, Tmin, steps, replicas, exchanges=100):
+		"""Minimizes the energy of a system by parallel tempering.
+		
+		Replicas of the state anneal in worker processes, each at its own
+		constant temperature on a geometric ladder from Tmax to Tmin.  After
+		every round of steps, replicas at neighboring temperatures trade
+		places according to the Metropolis criterion, so a replica stuck in
+		a local minimum at low temperature can be heated out of it.
+		
+		Keyword arguments:
+		state -- an initial arrangement of the system
+		Tmax -- maximum temperature (in units of energy)
+		Tmin -- minimum temperature (must be greater than zero)
+		steps -- the number of steps requested of each replica
+		replicas -- the number of replicas and worker processes
+		exchanges -- the number of rounds of exchanges between replicas
+		
+		Returns the best state and energy found by any replica."""
+		
+		start = time.time()
+		
+		if replicas < 2:
+			return self.anneal(state, Tmax, Tmin, steps)
+		
+		# Temperature of each rung on the ladder, and the replica on it
+		Ts = [Tmax * (float(Tmin) / Tmax) ** (float(i) / (replicas - 1))
+			for i in range(replicas)]
+		rungs = range(replicas)
+		
+		workers = []
+		for i in range(replicas):
+			connection, child = Pipe()
+			process = Process(target=self._replica, args=(state, child))
+			process.start()
+			workers.append((process, connection))
+		
+		print ' Exchange   Best Energy     Swaps     Elapsed   Remaining'
+		
+		rounds = max(1, exchanges)
+		swaps, tries = 0, 0
+		for exchange in range(rounds):
+			
+			# Anneal every replica at its current temperature
+			for (rung, replica) in enumerate(rungs):
+				workers[replica][1].send((Ts[rung], int(steps) // rounds))
+			energies = [connection.recv() for (process, connection) in workers]
+			
+			# Offer swaps between alternating pairs of neighboring rungs
+			for rung in range(exchange % 2, replicas - 1, 2):
+				a, b = rungs[rung], rungs[rung + 1]
+				delta = (1.0/Ts[rung] - 1.0/Ts[rung + 1]) * (energies[a] - energies[b])
+				tries += 1
+				if delta >= 0.0 or math.exp(delta) > random.random():
+					rungs[rung], rungs[rung + 1] = b, a
+					swaps += 1
+			
+			if (exchange + 1) % max(1, rounds // 20) == 0:
+				elapsed = time.time() - start
+				remain = (rounds - exchange - 1) * (elapsed / (exchange + 1))
+				print '%9d  %12.2f  %7.2f%%  %s  %s' % \
+					(exchange + 1, min(energies), 100.0*swaps/max(1, tries),
+						time_string(elapsed), time_string(remain))
+				self._record('progress', method='temper', exchange=exchange + 1,
+					exchanges=rounds, energy=min(energies),
+					swaps=float(swaps)/max(1, tries), elapsed=elapsed)
+				swaps, tries = 0, 0
+		
+		# Collect the best state from every replica
+		bests = []
+		for (process, connection) in workers:
+			connection.send('best')
+			bests.append(connection.recv())
+			connection.send(None)
+			process.join()
+		
+		bestEnergy, bestState = min(bests, key=lambda best: best[0])
+		self._record('anneal', method='temper', Tmax=Tmax, Tmin=Tmin, steps=steps,
+			replicas=replicas, seconds=time.time() - start, energy=bestEnergy)
+		return self.restore(state, bestState), bestEnergy
+	
+	def calibrate(self, state, samples, hot=0.98, cold=0.02):
+		"""Estimates a temperature schedule from the energy changes of a
+		sample of moves, each made and then undone.
+		
+		Tmax is the temperature at which the sampled moves that increase
+		the energy would be accepted with probability hot on average, and
+		Tmin the one at which they would be accepted with probability cold.
+		
+		Keyword arguments:
+		state -- an initial arrangement of the system
+		samples -- the number of moves to sample
+		hot -- average acceptance of energy-increasing moves at Tmax
+		cold -- average acceptance of energy-increasing moves at Tmin
+		
+		Returns the state, Tmax, Tmin, and the number of moves per second."""
+		
+		start = time.time()
+		E = self.energy(state)
+		deltas = []
+		proposing, committing, commits = 0.0, 0.0, 0
+		for sample in range(samples):
+			if self.propose is not None:
+				begin = time.time()
+				proposal, dE, bias = self.propose(state)
+				proposing += time.time() - begin
+				deltas.append(dE)
+				if sample % 4 == 0:
+					# Commit and revert one in four, to time commits too
+					begin = time.time()
+					state, token = self.commit(state, proposal)
+					state, token = self.commit(state, token)
+					committing += time.time() - begin
+					commits += 2
+				continue
+			token = self.move(state)
+			deltas.append(self.energy(state) - E)
+			state, token = self.undo(state, token)
+		if self.propose is not None:
+			# Every move is proposed, and about half are committed over
+			# a schedule from hot to cold
+			perMove = (proposing + 0.5 * samples * committing / max(commits, 1)) / max(samples, 1)
+			rate = 1.0 / max(perMove, 1e-9)
+		else:
+			rate = samples / max(time.time() - start, 1e-6)
+		
+		uphill = [dE for dE in deltas if dE > 0.0] \
+			or [abs(dE) for dE in deltas if dE != 0.0] or [1.0]
+		
+		def acceptance(T):
+			return sum([math.exp(-dE/T) for dE in uphill]) / len(uphill)
+		
+		def solve(target):
+			"""Bisects for the temperature giving the target acceptance."""
+			low, high = math.log(min(uphill) / 1e3), math.log(max(uphill) * 1e3)
+			for i in range(60):
+				middle = (low + high) / 2
+				if acceptance(math.exp(middle)) < target:
+					low = middle
+				else:
+					high = middle
+			return round_figures(math.exp(high), 2)
+		
+		Tmax, Tmin = solve(hot), solve(cold)
+		self._record('calibrate', method='samples', samples=samples,
+			seconds=time.time() - start, rate=rate, Tmax=Tmax, Tmin=Tmin)
+		return state, Tmax, Tmin, rate
 	
-	def auto(self, state, minutes, steps=2000):
+	def auto(self, state, minutes, steps=2000, replicas=1, samples=0, hot=0.98, resume=False):
 		"""Minimizes the energy of a system by simulated annealing with
 		automatic selection of the temperature schedule.
 		
@@ -168,35 +622,78 @@ class Annealer:
 		state -- an initial arrangement of the system
 		minutes -- time to spend annealing (after exploring temperatures)
 		steps -- number of steps to spend on each stage of exploration
+		replicas -- number of worker processes for parallel tempering,
+		            or one for plain annealing in this process
+		samples -- number of moves to sample for calibrate(), instead of
+		           exploring; minutes then include the time to calibrate
+		hot -- acceptance rate at the starting temperature, lower to
+		       start cooler from an arrangement that is already good
+		resume -- carry on from the checkpoint file if there is one,
+		          skipping straight to its place in the schedule
 		
 		Returns the best state and energy found."""
 		
+		start = time.time()
+		
+		checkpoint = resume and self.load_checkpoint() or None
+		if checkpoint is not None:
+			print 'Resuming anneal from %.2f to %.2f at step %i of %i:' % \
+				(checkpoint['Tmax'], checkpoint['Tmin'], checkpoint['step'], checkpoint['steps'])
+			return self.anneal(state, None, None, None, 20, checkpoint)
+		
+		print 'Attempting automatic simulated anneal...'
+		
+		if samples > 0:
+			state, Tmax, Tmin, rate = self.calibrate(state, samples, hot)
+			elapsed = time.time() - start
+			duration = round_figures(int(rate * max(60.0 * minutes - elapsed, 1.0)), 2)
+			print 'Calibrated from %i sample moves in %s, %.1f%% of the time available.' % \
+				(samples, time_string(elapsed).strip(), 100.0 * elapsed / max(60.0 * minutes, 1.0))
+		
+		else:
+			state, Tmax, Tmin, duration = self._explore(state, minutes, steps, start, hot)
+		
+		# Perform anneal
+		if replicas > 1:
+			print 'Tempering %i replicas from %.2f to %.2f over %i steps:' % (replicas, Tmax, Tmin, duration)
+			return self.temper(state, Tmax, Tmin, duration, replicas)
+		
+		if self.sweep is not None:
+			# Sweeps make moves at their own rate, so time one first,
+			# after another to get any setup out of the way
+			state, tried, accepted = self.sweep(state, Tmax)
+			begin = time.time()
+			state, tried, accepted = self.sweep(state, Tmax)
+			rate = tried / max(time.time() - begin, 1e-6)
+			duration = round_figures(int(rate * max(60.0 * minutes - (time.time() - start), 1.0)), 2)
+			print 'Annealing from %.2f to %.2f in sweeps over %i steps:' % (Tmax, Tmin, duration)
+			return self.sweeps(state, Tmax, Tmin, duration, 20)
+		
+		print 'Annealing from %.2f to %.2f over %i steps:' % (Tmax, Tmin, duration)
+		return self.anneal(state, Tmax, Tmin, duration, 20)
+	
+	def _explore(self, state, minutes, steps, start, hot):
+		"""Searches for Tmax and Tmin by annealing repeatedly at constant
+		temperatures, and estimates the steps that fit in the time available.
+		
+		Returns the state, Tmax, Tmin, and the number of steps."""
+		
 		def run(state, T, steps):
 			"""Anneals a system at constant temperature and returns the state,
 			energy, rate of acceptance, and rate of improvement."""
 			E = self.energy(state)
-			prevState = copy.deepcopy(state)
 			prevEnergy = E
 			accepts, improves = 0, 0
 			for step in range(steps):
-				self.move(state)
-				E = self.energy(state)
-				dE = E - prevEnergy
-				if dE > 0.0 and math.exp(-dE/T) < random.random():
-					state = copy.deepcopy(prevState)
-					E = prevEnergy
-				else:
+				state, E, dE, token, accepted = self._attempt(state, T, prevEnergy)
+				if accepted:
 					accepts += 1
 					if dE < 0.0:
 						improves += 1
-					prevState = copy.deepcopy(state)
 					prevEnergy = E
 			return state, E, float(accepts)/steps, float(improves)/steps
 		
 		step = 0
-		start = time.time()
-		
-		print 'Attempting automatic simulated anneal...'
 		
 		# Find an initial guess for temperature
 		T = 0.0
@@ -215,15 +712,15 @@ class Annealer:
 			print '%12.2f  %12.2f  %7.2f%%  %7.2f%%  %s' % \
 				(T, E, 100.0*acceptance, 100.0*improvement, time_string(elapsed))
 		
-		# Search for Tmax - a temperature that gives 98% acceptance
+		# Search for Tmax - a temperature that gives hot (98%) acceptance
 		state, E, acceptance, improvement = run(state, T, steps)
 		step += steps
-		while acceptance > 0.98:
+		while acceptance > hot:
 			T = round_figures(T/1.5, 2)
 			state, E, acceptance, improvement = run(state, T, steps)
 			step += steps
 			update(T, E, acceptance, improvement)
-		while acceptance < 0.98:
+		while acceptance < hot:
 			T = round_figures(T*1.5, 2)
 			state, E, acceptance, improvement = run(state, T, steps)
 			step += steps
@@ -241,10 +738,10 @@ class Annealer:
 		# Calculate anneal duration
 		elapsed = time.time() - start
 		duration = round_figures(int(60.0 * minutes * step / elapsed), 2)
+		self._record('calibrate', method='explore', steps=step, seconds=elapsed,
+			rate=step / elapsed, Tmax=Tmax, Tmin=Tmin)
 		
-		# Perform anneal
-		print 'Annealing from %.2f to %.2f over %i steps:' % (Tmax, Tmin, duration)
-		return self.anneal(state, Tmax, Tmin, duration, 20)
+		return state, Tmax, Tmin, duration
 
 if __name__ == '__main__':
 	"""Test annealer with a traveling salesman problem."""
@@ -287,9 +784,14 @@ if __name__ == '__main__':
 	random.shuffle(state)
 	
 	# Minimize the distance to be traveled by simulated annealing with a
-	# manually chosen temperature schedule
-	annealer = Annealer(route_energy, route_move)
+	# manually chosen temperature schedule, checking that without patience
+	# every step of it is run
+	events = []
+	annealer = Annealer(route_energy, route_move,
+		metrics=lambda event, values: events.append((event, values)))
 	state, e = annealer.anneal(state, 10000000, 0.01, 18000*len(state), 9)
+	assert [(values['made'], values['early']) for (event, values) in events
+		if event == 'anneal'] == [(18000*len(state), False)]
 	while state[0] != 'New York City':
 		state = state[1:] + state[:1]  # rotate NYC to start
 	print "%i mile route:" % route_energy(state)
@@ -1,18 +1,30 @@
-from os.path import exists
-from csv import DictReader
-from math import sin, cos, pi, hypot
-from json import dump as dumpjson
+from os import remove
+from os.path import exists, join, splitext
+from glob import glob
+from time import time
+from math import sin, cos, pi, hypot, atan2
+from json import load as loadjson, dump as dumpjson, dumps
+from hashlib import md5
 from itertools import combinations
 from optparse import OptionParser, OptParseError
-from gzip import GzipFile
 from copy import deepcopy
-from random import choice, random
+from random import choice, random, seed
+from multiprocessing import Pool, Array, cpu_count
+
+from numpy import array, empty, zeros, arange, repeat, concatenate, bincount, exp, minimum
 
 from PIL.Image import new as newimg
 from PIL.ImageDraw import Draw as drawimg
-from PIL.ImageFont import truetype
 
 from anneal import Annealer
+from fontmetrics import FontMetrics
+from geometry import Rectangles, NOWHERE, intersects, buffered, blocks, conflict_table
+from mercator import project, unproject
+from columns import open_columns, NO_POPULATION
+from cull import cull
+from shapefiles import write_points, write_polygons, read_features
+from tiles import hilbert_order, write_tile_index
+from telemetry import Phases, record, verbose, set_context, setup as setup_telemetry
 
 from ModestMaps import mapByCenterZoom
 from ModestMaps.Geo import Location
@@ -28,6 +40,24 @@ placements = {NE: 0.000, ENE: 0.070, ESE: 0.100, SE: 0.175, SSE: 0.200,
               S: 0.900, SW: 0.600, WSW: 0.500, WNW: 0.470, NW: 0.400,
               NNW: 0.575, N: 0.800, NNE: 0.150}
 
+# share of annealing time spent on seams between tiles
+SEAM_TIME = .2
+
+# acceptance of uphill moves at the starting temperature, normally and
+# when seeded with labels from the zoom before, which are close already
+HOT, SEEDED_HOT = .98, .5
+
+# share of a job's time left unused for it to count as settled early, and
+# the least spare time in minutes worth annealing a job again for
+SETTLED_TIME, SPARE_TIME = .1, .05
+
+# fields of points and labels written as shapefiles, text or number
+SHAPEFILE_FIELDS = [('name', 'C'), ('rank', 'N'), ('population', 'N'),
+                    ('geonameid', 'C'), ('capital', 'C'), ('place', 'C')]
+
+# spare minutes and count of unfinished jobs, shared by arrange_zoom() workers
+_spare = None
+
 optparser = OptionParser(usage="""%prog [options] <city input files>
 """)
 
@@ -37,6 +67,23 @@ defaults = {
     'points': 'out-points.json',
     'labels': 'out-labels.json',
     'countries': 'Countries.csv',
+    'processes': cpu_count(),
+    'tilesize': 0,
+    'replicas': 1,
+    'samples': 2000,
+    'fontmetrics': 'font-metrics.marshal',
+    'inputcache': 'input-cache',
+    'config': None,
+    'zooms': '0-22',
+    'seed': None,
+    'focus': 0.5,
+    'sweeps': False,
+    'patience': 0.0,
+    'incremental': False,
+    'resume': False,
+    'hilbert': False,
+    'verbose': False,
+    'metrics': None,
     'countryfont': ('fonts/DejaVuSans.ttf', 12),
     'pop25mfont': ('fonts/DejaVuSans.ttf', 14),
     'pop250kfont': ('fonts/DejaVuSans.ttf', 12),
@@ -50,10 +97,10 @@ optparser.add_option('-c', '--countries', dest='countries',
                      type='string', help='Input filename for countries. Default value is "%(countries)s".' % defaults)
 
 optparser.add_option('-p', '--points', dest='points',
-                     type='string', help='Output filename for points. Default value is "%(points)s".' % defaults)
+                     type='string', help='Output filename for points, GeoJSON or a shapefile ending in .shp. Default value is "%(points)s".' % defaults)
 
 optparser.add_option('-l', '--labels', dest='labels',
-                     type='string', help='Output filename for labels. Default value is "%(labels)s".' % defaults)
+                     type='string', help='Output filename for labels, GeoJSON or a shapefile ending in .shp. Default value is "%(labels)s".' % defaults)
 
 optparser.add_option('-m', '--minutes', dest='minutes',
                      type='float', help='Number of minutes to run annealer. Default value is %(minutes).1f.' % defaults)
@@ -61,6 +108,57 @@ optparser.add_option('-m', '--minutes', dest='minutes',
 optparser.add_option('-z', '--zoom', dest='zoom',
                      type='int', help='Map zoom level. Default value is %(zoom)d.' % defaults)
 
+optparser.add_option('-j', '--processes', dest='processes',
+                     type='int', help='Number of processes for annealing independent groups of places. Default value is %(processes)d.' % defaults)
+
+optparser.add_option('-r', '--replicas', dest='replicas',
+                     type='int', help='Number of replicas for parallel tempering, each in its own process. Default value is %(replicas)d, for plain annealing.' % defaults)
+
+optparser.add_option('-s', '--samples', dest='samples',
+                     type='int', help='Number of sample moves for calibrating annealing temperatures. Default value is %(samples)d, or 0 to explore temperatures by trial runs instead.' % defaults)
+
+optparser.add_option('--focus', dest='focus',
+                     type='float', help='Fraction of moves spent on places that overlap a neighbor, from 0 for none up to but not including 1. Default value is %(focus).1f.' % defaults)
+
+optparser.add_option('--sweeps', dest='sweeps',
+                     action='store_true', help='Anneal in sweeps, moving every place once per temperature with places that are not neighbors moved together.')
+
+optparser.add_option('--patience', dest='patience',
+                     type='float', help='Fraction of the annealing schedule to go on without improving before stopping early, or 0 to always use all the time. Default value is %(patience).2f.' % defaults)
+
+optparser.add_option('--seed', dest='seed',
+                     type='string', help='Labels output from another zoom, usually the one before, to start from instead of scratch, as GeoJSON or a shapefile ending in .shp. Annealing then starts cooler.')
+
+optparser.add_option('-i', '--incremental', dest='incremental',
+                     action='store_true', help='Keep the arrangement saved with the labels output by the last run, and anneal only places near ones that changed since.')
+
+optparser.add_option('--resume', dest='resume',
+                     action='store_true', help='Pick up annealing from the checkpoints saved beside the labels output by a run that was interrupted.')
+
+optparser.add_option('--hilbert', dest='hilbert',
+                     action='store_true', help='Write places in order along a Hilbert curve, with an index of the byte ranges in each map tile beside each output, ending in "-tiles.json".')
+
+optparser.add_option('-t', '--tile-size', dest='tilesize',
+                     type='int', help='Anneal square tiles of this many pixels in parallel, then the seams between them. Default value is %(tilesize)d, for no tiles.' % defaults)
+
+optparser.add_option('--font-metrics', dest='fontmetrics',
+                     type='string', help='Cache file for measured label sizes, shared between runs. Default value is "%(fontmetrics)s".' % defaults)
+
+optparser.add_option('--input-cache', dest='inputcache',
+                     type='string', help='Directory for parsed input files, reused until they change. Default value is "%(inputcache)s".' % defaults)
+
+optparser.add_option('--config', dest='config',
+                     type='string', help='JSON file of jobs for many zooms, run in parallel with one process each instead of the single zoom given by other options.')
+
+optparser.add_option('--zooms', dest='zooms',
+                     type='string', help='Range of zooms to run from the config file, like "3-11". Default value is "%(zooms)s".' % defaults)
+
+optparser.add_option('-v', '--verbose', dest='verbose',
+                     action='store_true', help='Print a line for every place loaded and every place skipped for overlapping another.')
+
+optparser.add_option('--metrics', dest='metrics',
+                     type='string', help='File to append timings of each phase and annealing progress to, as lines of JSON.')
+
 optparser.add_option('--country-font', dest='countryfont',
                      type='string', nargs=2, help='Font filename and point size for countries. Default value is "%s", %d.' % (defaults['popotherfont'][0], defaults['popotherfont'][1]))
 
@@ -79,12 +177,20 @@ optparser.add_option('--popother-font', dest='popotherfont',
 def coin_flip():
     return choice((True, False))
 
+def clamp(value, limit):
+    return min(max(value, -limit), limit)
+
 def compare_places(this, that):
     this = -int(this.__class__ is Country), this.rank, -(this.population or 0)
     that = -int(that.__class__ is Country), that.rank, -(that.population or 0)
     
     return cmp(this, that)
 
+def overlap_weight(this, that):
+    """ Return the energy of two places overlapping, more for higher-ranked places.
+    """
+    return min(10.0 / this.rank, 10.0 / that.rank)
+
 class Country:
 
     def __init__(self, name, abbreviation, rank, zoom, land_area, population, location, position, font):
@@ -123,9 +229,17 @@ class Country:
     def _update_label_shape(self):
         """
         """
-        x, y = self.position.x, self.position.y
+        self._label_shape = self.label_bbox_at(self.save())
+    
+    def label_bbox(self):
+        return self._label_shape
+    
+    def label_bbox_at(self, saved):
+        """ Return the label box for an arrangement in the form of save().
+        """
+        use_abbr, x, y = saved
         
-        if self.use_abbr:
+        if use_abbr:
             width, height = self._minwidth, self._minheight
         else:
             width, height = self._maxwidth, self._maxheight
@@ -133,52 +247,85 @@ class Country:
         x1, y1 = x - width/2, y - height/2
         x2, y2 = x + width/2, y + height/2
         
-        self._label_shape = Polygon(((x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)))
-    
-    def label_bbox(self):
-        return self._label_shape.envelope
+        return x1, y1, x2, y2
     
     def mask_shape(self):
-        return self._label_shape.buffer(self.buffer).envelope
+        return (buffered(self._label_shape, self.buffer), )
     
-    def move(self):
-        self.use_abbr = coin_flip()
+    def propose(self):
+        """ Return a random new arrangement in the form of save(), without moving.
+        """
+        use_abbr = coin_flip()
     
-        width = self.use_abbr and self._minwidth or self._maxwidth
-        height = self.use_abbr and self._minheight or self._maxheight
+        width = use_abbr and self._minwidth or self._maxwidth
+        height = use_abbr and self._minheight or self._maxheight
         
         x = (random() - .5) * width
         y = (random() - .5) * height
+        
+        return use_abbr, self._original.x + x, self._original.y + y
+    
+    def move(self):
+        self.restore(self.propose())
     
-        self.position.x = self._original.x + x
-        self.position.y = self._original.y + y
+    def save(self):
+        return self.use_abbr, self.position.x, self.position.y
+    
+    def restore(self, saved):
+        self.use_abbr, self.position.x, self.position.y = saved
+        self._update_label_shape()
+    
+    def seed(self, bbox, use_abbr):
+        """ Move the label as near as it can go to a box from another zoom level.
+        """
+        self.use_abbr = use_abbr
+        
+        width = self.use_abbr and self._minwidth or self._maxwidth
+        height = self.use_abbr and self._minheight or self._maxheight
+        
+        x1, y1, x2, y2 = bbox
+        
+        self.position.x = self._original.x + clamp((x1 + x2)/2 - self._original.x, width/2.0)
+        self.position.y = self._original.y + clamp((y1 + y2)/2 - self._original.y, height/2.0)
         
         self._update_label_shape()
     
     def placement_energy(self):
-        width = self.use_abbr and self._minwidth or self._maxwidth
+        return self.placement_energy_at(self.save())
+    
+    def placement_energy_at(self, saved):
+        """ Return the placement energy of an arrangement in the form of save().
+        """
+        use_abbr, x, y = saved
+        width = use_abbr and self._minwidth or self._maxwidth
         
-        x = 2 * (self.position.x - self._original.x) / width
-        y = 2 * (self.position.y - self._original.y) / width
+        x = 2 * (x - self._original.x) / width
+        y = 2 * (y - self._original.y) / width
         
-        return int(self.use_abbr) + hypot(x, y) ** 2
+        return int(use_abbr) + hypot(x, y) ** 2
     
     def overlap_energy(self, other):
         if self.overlaps(other):
-            return min(10.0 / self.rank, 10.0 / other.rank)
+            return overlap_weight(self, other)
 
         return 0.0
     
     def overlaps(self, other, reflexive=True):
-        overlaps = self.mask_shape().intersects(other.label_bbox())
+        label = other.label_bbox()
+        overlaps = any([intersects(mask, label) for mask in self.mask_shape()])
         
         if reflexive:
             overlaps |= other.overlaps(self, False)
 
         return overlaps
 
+    def reach(self):
+        """ Return the distance within which another place might overlap this one.
+        """
+        return hypot(self._maxwidth + self.buffer*2, self._maxheight + self.buffer*2)
+
     def in_range(self, other, reflexive=True):
-        range = hypot(self._maxwidth + self.buffer*2, self._maxheight + self.buffer*2)
+        range = self.reach()
         distance = hypot(self.position.x - other.position.x, self.position.y - other.position.y)
         in_range = distance <= range
         
@@ -205,10 +352,11 @@ class City:
         x1, y1 = position.x - self.radius, position.y - self.radius
         x2, y2 = position.x + self.radius, position.y + self.radius
         
-        self._point_shape = Polygon(((x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)))
+        self._point_shape = x1, y1, x2, y2
         self._label_shape = None
 
         self._width, self._height = font.getsize(self.name)
+        self._label_shapes = [self._placement_shape(p) for p in sorted(placements)]
         self._update_label_shape()
 
     def __repr__(self):
@@ -223,83 +371,135 @@ class City:
     def __unicode__(self):
         return unicode(self.name)
     
-    def _update_label_shape(self):
-        """
+    def _placement_shape(self, placement):
+        """ Return the label box for a given placement.
         """
         x, y = self.position.x, self.position.y
         
-        if self.placement in (NE, ENE, ESE, SE):
+        if placement in (NE, ENE, ESE, SE):
             x += self.radius + self._width/2
         
-        if self.placement in (NW, WNW, WSW, SW):
+        if placement in (NW, WNW, WSW, SW):
             x -= self.radius + self._width/2
 
-        if self.placement in (NW, NE):
+        if placement in (NW, NE):
             y -= self._height/2
 
-        if self.placement in (SW, SE):
+        if placement in (SW, SE):
             y += self._height/2
 
-        if self.placement in (ENE, WNW):
+        if placement in (ENE, WNW):
             y -= self._height/6
 
-        if self.placement in (ESE, WSW):
+        if placement in (ESE, WSW):
             y += self._height/6
         
-        if self.placement in (NNE, SSE, NNW):
+        if placement in (NNE, SSE, NNW):
             _x = self.radius * cos(pi/4) + self._width/2
             _y = self.radius * sin(pi/4) + self._height/2
             
-            if self.placement in (NNE, SSE):
+            if placement in (NNE, SSE):
                 x += _x
             else:
                 x -= _x
             
-            if self.placement in (SSE, ):
+            if placement in (SSE, ):
                 y += _y
             else:
                 y -= _y
         
-        if self.placement == N:
+        if placement == N:
             y -= self.radius + self._height / 2
         
-        if self.placement == S:
+        if placement == S:
             y += self.radius + self._height / 2
         
         x1, y1 = x - self._width/2, y - self._height/2
         x2, y2 = x + self._width/2, y + self._height/2
         
-        self._label_shape = Polygon(((x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)))
+        return x1, y1, x2, y2
+    
+    def _update_label_shape(self):
+        """
+        """
+        self._label_shape = self._label_shapes[self.placement]
     
     def label_bbox(self):
-        return self._label_shape.envelope
+        return self._label_shape
+    
+    def label_bboxes(self):
+        """ Return label boxes for every placement, indexed by placement.
+        """
+        return self._label_shapes
     
     def mask_shape(self):
-        return self._label_shape.buffer(self.buffer).envelope.union(self._point_shape)
+        return buffered(self._label_shape, self.buffer), self._point_shape
+    
+    def label_bbox_at(self, saved):
+        """ Return the label box for an arrangement in the form of save().
+        """
+        return self._label_shapes[saved]
+    
+    def propose(self):
+        """ Return a random new arrangement in the form of save(), without moving.
+        """
+        return choice(placements.keys())
     
     def move(self):
-        self.placement = choice(placements.keys())
+        self.restore(self.propose())
+    
+    def save(self):
+        return self.placement
+    
+    def restore(self, saved):
+        self.placement = saved
+        self._update_label_shape()
+    
+    def seed(self, bbox):
+        """ Choose the placement in the same direction as a label box from another zoom level.
+        """
+        x, y = self.position.x, self.position.y
+        
+        def direction(bbox):
+            x1, y1, x2, y2 = bbox
+            return atan2((y1 + y2)/2 - y, (x1 + x2)/2 - x)
+        
+        angle = direction(bbox)
+        turns = [abs((direction(shape) - angle + pi) % (2*pi) - pi) for shape in self._label_shapes]
+        
+        self.placement = turns.index(min(turns))
         self._update_label_shape()
     
     def placement_energy(self):
         return placements[self.placement]
     
+    def placement_energy_at(self, saved):
+        """ Return the placement energy of an arrangement in the form of save().
+        """
+        return placements[saved]
+    
     def overlap_energy(self, other):
         if self.overlaps(other):
-            return min(10.0 / self.rank, 10.0 / other.rank)
+            return overlap_weight(self, other)
 
         return 0.0
     
     def overlaps(self, other, reflexive=True):
-        overlaps = self.mask_shape().intersects(other.label_bbox())
+        label = other.label_bbox()
+        overlaps = any([intersects(mask, label) for mask in self.mask_shape()])
         
         if reflexive:
             overlaps |= other.overlaps(self, False)
 
         return overlaps
 
+    def reach(self):
+        """ Return the distance within which another place might overlap this one.
+        """
+        return self.radius + hypot(self._width + self.buffer*2, self._height + self.buffer*2)
+
     def in_range(self, other, reflexive=True):
-        range = self.radius + hypot(self._width + self.buffer*2, self._height + self.buffer*2)
+        range = self.reach()
         distance = hypot(self.position.x - other.position.x, self.position.y - other.position.y)
         in_range = distance <= range
         
@@ -337,39 +537,73 @@ class HighZoomCity(City):
     def _update_label_shape(self):
         """
         """
-        x, y = self.position.x, self.position.y
+        self._label_shape = self.label_bbox_at(self.save())
+    
+    def label_bbox_at(self, saved):
+        """ Return the label box for an arrangement in the form of save().
+        """
+        x, y = saved
         
         x1, y1 = x - self._width/2, y - self._height/2
         x2, y2 = x + self._width/2, y + self._height/2
         
-        self._label_shape = Polygon(((x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)))
+        return x1, y1, x2, y2
     
     def mask_shape(self):
-        return self._label_shape.buffer(self.buffer).envelope
+        return (buffered(self._label_shape, self.buffer), )
     
-    def move(self):
+    def propose(self):
+        """ Return a random new arrangement in the form of save(), without moving.
+        """
         x = (random() - .5) * self._width
         y = (random() - .5) * self._height
+        
+        return self._original.x + x, self._original.y + y
+    
+    def move(self):
+        self.restore(self.propose())
+    
+    def save(self):
+        return self.position.x, self.position.y
     
-        self.position.x = self._original.x + x
-        self.position.y = self._original.y + y
+    def restore(self, saved):
+        self.position.x, self.position.y = saved
+        self._update_label_shape()
+    
+    def seed(self, bbox):
+        """ Move the label as near as it can go to a box from another zoom level.
+        """
+        x1, y1, x2, y2 = bbox
+        
+        self.position.x = self._original.x + clamp((x1 + x2)/2 - self._original.x, self._width/2.0)
+        self.position.y = self._original.y + clamp((y1 + y2)/2 - self._original.y, self._height/2.0)
         
         self._update_label_shape()
     
     def placement_energy(self):
-        x = 2 * (self.position.x - self._original.x) / self._width
-        y = 2 * (self.position.y - self._original.y) / self._width
+        return self.placement_energy_at(self.save())
+    
+    def placement_energy_at(self, saved):
+        """ Return the placement energy of an arrangement in the form of save().
+        """
+        x = 2 * (saved[0] - self._original.x) / self._width
+        y = 2 * (saved[1] - self._original.y) / self._width
         
         return hypot(x, y) ** 2
     
     def overlap_energy(self, other):
         if self.overlaps(other):
-            return min(10.0 / self.rank, 10.0 / other.rank)
+            return overlap_weight(self, other)
 
         return 0.0
     
+    def reach(self):
+        """ Return the distance within which another place might overlap this one.
+        """
+        return hypot(self._width + self.buffer*2, self._height + self.buffer*2)
+
     def in_range(self, other, reflexive=True):
-        range = hypot(self._width + self.buffer*2, self._height + self.buffer*2)
+        range = self.reach()
         distance = hypot(self.position.x - other.position.x, self.position.y - other.position.y)
         in_range = distance <= range
         
@@ -379,20 +613,338 @@ class HighZoomCity(City):
         return in_range
 
 class Places:
-
-    def __init__(self):
+    """ Places with their neighbors and the energy of their arrangement.
+    
+        With focus above zero, that fraction of moves goes to places that
+        overlap a neighbor, and the rest to any moveable place. The chance
+        of a move being proposed changes with it, so bias() gives the
+        Hastings ratio for the annealer to keep detailed balance.
+        
+        With sweeps, the annealer moves every moveable place in turn
+        with sweep() instead of one random place at a time with move().
+        Otherwise it uses propose() and commit(), so that moves it rejects
+        are never made.
+        
+        With patience above zero, annealing stops early once the energy
+        has not improved for that fraction of the moves, or once settled()
+        finds no moveable place overlapping another.
+    """
+    def __init__(self, cellsize=256, focus=0.0, sweeps=False, patience=0.0):
+        self.focus = focus
+        self.sweeps = sweeps
+        self.patience = patience
         self._places = []
         self._energy = 0.0
         self._neighbors = {}
         self._moveable = []
+        self._moveable_set = set()
+        
+        # uniform grid of places keyed on pixel position, for finding neighbors
+        self._cells = {}
+        self._cellsize = float(cellsize)
+        self._reach = 0.0
+        
+        # array-backed label geometry and neighbor lists, built by _prepare()
+        self._index = None
+        self._rects = None
+        self._adjacent = None
+        self._placements = None
+        self._choices = None
+        
+        # overlapping neighbors of every place, and the moveable places with
+        # any as an indexed set, built by _count_conflicts() for focused moves
+        self._counts = None
+        self._conflicted = []
+        self._conflicted_at = {}
+        
+        # moveable places colored so no two neighbors share a color, with
+        # their neighbor pairs as flat arrays, built by _color() for sweeps
+        self._colors = None
+        
+        # the latest proposal with its changes to conflict counts, for commit()
+        self._proposed = None
 
     def __iter__(self):
         return iter(self._places)
 
+    def _cell(self, x, y):
+        return int(x // self._cellsize), int(y // self._cellsize)
+    
+    def _candidates(self, place):
+        """ Generate places from grid cells near enough to be in range of place.
+        """
+        return self._nearby(place.position.x, place.position.y, max(place.reach(), self._reach))
+
+    def _nearby(self, x, y, reach):
+        """ Generate places from grid cells within reach of a point.
+        """
+        col1, row1 = self._cell(x - reach, y - reach)
+        col2, row2 = self._cell(x + reach, y + reach)
+        
+        for col in range(col1, col2 + 1):
+            for row in range(row1, row2 + 1):
+                for other in self._cells.get((col, row), ()):
+                    yield other
+
+    def _prepare(self):
+        """ Build array-backed label geometry and neighbor lists for moves, if needed.
+        
+            Pairs of neighboring cities each have only a few possible placements,
+            so their overlaps are precomputed into conflict tables and looked up
+            by placement. Other pairs are tested against their current labels.
+        """
+        if self._adjacent is not None:
+            return
+        
+        self._counts = None
+        self._colors = None
+        self._index = dict([(place, i) for (i, place) in enumerate(self._places)])
+        self._rects = Rectangles(len(self._places))
+        self._placements = empty(len(self._places), dtype=int)
+        self._adjacent = []
+        self._choices = {}
+        
+        choices = self._choices
+        
+        for (index, place) in enumerate(self._places):
+            point = getattr(place, '_point_shape', NOWHERE)
+            self._rects.set(index, place.label_bbox(), place.buffer, point)
+            
+            if place.__class__ is City:
+                self._placements[index] = place.placement
+                choices[index] = [blocks(label, place.buffer, point) for label in place.label_bboxes()]
+            else:
+                self._placements[index] = -1
+        
+        for place in self._places:
+            index = self._index[place]
+            neighbors = [self._index[other] for other in self._neighbors[place]]
+            others = [other for other in neighbors if other not in choices or index not in choices]
+            tabled = [other for other in neighbors if other in choices and index in choices]
+            
+            indexes = array(others, dtype=int)
+            weights = array([overlap_weight(place, self._places[other]) for other in others], dtype=float)
+            
+            tabled_indexes = array(tabled, dtype=int)
+            tabled_weights = array([overlap_weight(place, self._places[other]) for other in tabled], dtype=float)
+            tables = array([conflict_table(choices[index], choices[other]) for other in tabled])
+            
+            # one row per placement of this place, one column per neighbor
+            tables = tables.reshape((len(tabled), len(placements))).T.copy()
+            
+            self._adjacent.append((indexes, weights, tabled_indexes, tabled_weights, tables))
+    
+    def _count_conflicts(self):
+        """ Count the overlapping neighbors of every place, for focused moves.
+        """
+        self._counts = zeros(len(self._places), dtype=int)
+        self._conflicted, self._conflicted_at = [], {}
+        
+        for index in range(len(self._places)):
+            neighbors, overlaps = self._overlaps(index)
+            self._counts[index] = overlaps.sum()
+        
+        for place in self._moveable:
+            if self._counts[self._index[place]]:
+                self._conflict(place, True)
+    
+    def _color(self):
+        """ Greedily color the moveable places, most neighbors first, for sweep().
+        
+            Each color is a tuple of arrays: indexes of its places, then
+            rows, columns and weights for every pair of one of those places
+            and a neighbor, then the same for pairs in conflict tables and
+            the columns of the tables for those pairs.
+        """
+        colors, taken = [], {}
+        
+        for place in sorted(self._moveable, key=lambda place: -len(self._neighbors[place])):
+            used = set([taken[other] for other in self._neighbors[place] if other in taken])
+            taken[place] = min(set(range(len(used) + 1)) - used)
+            
+            if taken[place] == len(colors):
+                colors.append([])
+            
+            colors[taken[place]].append(self._index[place])
+        
+        self._colors = []
+        
+        for members in colors:
+            adjacent = [self._adjacent[index] for index in members]
+            others, weights, tabled, tabled_weights, tables = zip(*adjacent)
+            rows = repeat(arange(len(members)), [len(indexes) for indexes in others])
+            tabled_rows = repeat(arange(len(members)), [len(indexes) for indexes in tabled])
+            
+            self._colors.append((array(members), rows, concatenate(others).astype(int), concatenate(weights),
+                                 tabled_rows, concatenate(tabled).astype(int), concatenate(tabled_weights),
+                                 concatenate(tables, 1).astype(int)))
+    
+    def _color_energy(self, color):
+        """ Return an array of the overlap energy of each place of a color with its neighbors.
+        """
+        members, rows, columns, weights, tabled_rows, tabled_columns, tabled_weights, tables = color
+        energy = zeros(len(members))
+        
+        if len(rows):
+            overlaps = self._rects.pair_overlaps(members[rows], columns)
+            energy += bincount(rows, weights * overlaps, len(members))
+        
+        if len(tabled_rows):
+            conflicts = tables[self._placements[members[tabled_rows]], arange(len(tabled_rows))]
+            conflicts = (conflicts >> self._placements[tabled_columns]) & 1
+            energy += bincount(tabled_rows, tabled_weights * conflicts, len(members))
+        
+        return energy
+    
+    def _conflict(self, place, conflicted):
+        """ Add a place to the indexed set of conflicted places, or remove it.
+        """
+        if conflicted and place not in self._conflicted_at:
+            self._conflicted_at[place] = len(self._conflicted)
+            self._conflicted.append(place)
+        
+        elif not conflicted and place in self._conflicted_at:
+            # fill the gap with the last place in the list
+            position, last = self._conflicted_at.pop(place), self._conflicted.pop()
+            
+            if last is not place:
+                self._conflicted[position] = last
+                self._conflicted_at[last] = position
+    
+    def _overlaps(self, index):
+        """ Return an array of neighbor indexes for the place at index, and one of which it overlaps.
+        """
+        others, weights, tabled, tabled_weights, tables = self._adjacent[index]
+        overlaps = self._rects.overlaps(index, others).astype(int)
+        
+        if len(tabled):
+            conflicts = (tables[self._placements[index]] >> self._placements[tabled]) & 1
+            return concatenate((others, tabled)), concatenate((overlaps, conflicts))
+        
+        return others, overlaps
+    
+    def _near_at(self, index, place, saved):
+        """ Return the near block of the place at index, were it arranged as saved.
+        """
+        if index in self._choices:
+            return self._choices[index][saved][0]
+        
+        return blocks(place.label_bbox_at(saved), place.buffer, getattr(place, '_point_shape', NOWHERE))[0]
+    
+    def _overlap_energy_at(self, index, place, saved):
+        """ Return what _overlap_energy() would be for the place at index, were it arranged as saved.
+        """
+        others, weights, tabled, tabled_weights, tables = self._adjacent[index]
+        energy = 0.0
+        
+        if len(others):
+            energy += weights[self._rects.near_overlaps(self._near_at(index, place, saved), others)].sum()
+        
+        if len(tabled):
+            conflicts = tables[saved] >> self._placements[tabled]
+            energy += tabled_weights.dot(conflicts & 1)
+        
+        return float(energy)
+    
+    def _overlaps_at(self, index, place, saved):
+        """ Return what _overlaps() would for the place at index, were it arranged as saved.
+        """
+        others, weights, tabled, tabled_weights, tables = self._adjacent[index]
+        overlaps = self._rects.near_overlaps(self._near_at(index, place, saved), others).astype(int)
+        
+        if len(tabled):
+            conflicts = (tables[saved] >> self._placements[tabled]) & 1
+            return concatenate((others, tabled)), concatenate((overlaps, conflicts))
+        
+        return others, overlaps
+    
+    def _recount(self, index, neighbors, changes):
+        """ Apply changes in which neighbors overlap the place at index to the conflict counts.
+        """
+        self._counts[index] += changes.sum()
+        self._counts[neighbors] += changes
+        
+        for other in [index] + neighbors[changes != 0].tolist():
+            place = self._places[other]
+            
+            if place in self._moveable_set:
+                self._conflict(place, self._counts[other] > 0)
+    
+    def _chance(self, place):
+        """ Return the probability of choosing place for the next move.
+        """
+        uniform = 1.0 / len(self._moveable)
+        
+        if not self._conflicted:
+            return uniform
+        
+        focused = place in self._conflicted_at and 1.0 / len(self._conflicted) or 0.0
+        return self.focus * focused + (1 - self.focus) * uniform
+    
+    def _chance_after(self, index, neighbors, changes):
+        """ Return what _chance() would be for the place at index after changes to conflict counts.
+        """
+        uniform = 1.0 / len(self._moveable)
+        counts = self._counts[neighbors] + changes
+        size = len(self._conflicted)
+        
+        for (other, count) in zip(neighbors[changes != 0].tolist(), counts[changes != 0].tolist()):
+            place = self._places[other]
+            
+            if place in self._moveable_set:
+                size += int(count > 0) - int(place in self._conflicted_at)
+        
+        conflicted = self._counts[index] + changes.sum() > 0
+        size += int(conflicted) - int(self._places[index] in self._conflicted_at)
+        
+        if not size:
+            return uniform
+        
+        return self.focus * (conflicted and 1.0 / size or 0.0) + (1 - self.focus) * uniform
+    
+    def _choose(self):
+        """ Return a random moveable place to move, more likely a conflicted one with focus.
+        """
+        if self.focus and self._counts is None:
+            self._count_conflicts()
+        
+        if self.focus and self._conflicted and random() < self.focus:
+            return choice(self._conflicted)
+        
+        return choice(self._moveable)
+    
+    def _overlap_energy(self, index):
+        """ Return the total overlap energy of the place at index with its neighbors.
+        """
+        others, weights, tabled, tabled_weights, tables = self._adjacent[index]
+        energy = 0.0
+        
+        if len(others):
+            energy += weights[self._rects.overlaps(index, others)].sum()
+        
+        if len(tabled):
+            conflicts = tables[self._placements[index]] >> self._placements[tabled]
+            energy += tabled_weights.dot(conflicts & 1)
+        
+        return float(energy)
+    
+    def _update(self, place):
+        """ Copy the current label of a place to the array-backed geometry.
+        """
+        index = self._index[place]
+        
+        if index in self._choices:
+            self._placements[index] = place.placement
+            self._rects.set_blocks(index, *self._choices[index][place.placement])
+        else:
+            self._rects.set_label(index, place.label_bbox(), place.buffer)
+
     def add(self, place):
+        self._adjacent = None
+        self._counts = None
         self._neighbors[place] = set()
     
-        for other in self._places:
+        for other in self._candidates(place):
             if not place.in_range(other):
                 continue
 
@@ -403,146 +955,621 @@ class Places:
         self._energy += place.placement_energy()
         self._places.append(place)
         
+        cell = self._cell(place.position.x, place.position.y)
+        self._cells.setdefault(cell, []).append(place)
+        self._reach = max(self._reach, place.reach())
+        
         if place.zoom <= 7:
             self._moveable.append(place)
+            self._moveable_set.add(place)
         
         return self._neighbors[place]
 
     def energy(self):
         return self._energy
     
-    def move(self):
-        place = choice(self._moveable)
-        
-        for other in self._neighbors[place]:
-            self._energy -= place.overlap_energy(other)
-
-        self._energy -= place.placement_energy()
-
-        place.move()
-        
-        for other in self._neighbors[place]:
-            self._energy += place.overlap_energy(other)
-
-        self._energy += place.placement_energy()
-
-def postprocess_args(opts, args):
-    """ Return inputfile, pointsfile, labelsfile, minutes, zoom, fonts after optparser.parse_args().
-    """
-    try:
-        inputfiles = args[0:]
-    except IndexError:
-        raise OptParseError('Input filename is required.')
+    def moveable(self):
+        return self._moveable
     
-    for inputfile in inputfiles:
-        if not exists(inputfile):
-            raise OptParseError('Non-existent input filename: "%(inputfile)s".' % locals())
-
-    minutes = opts.minutes
-
-    if minutes <= 0:
-        raise OptParseError('Minutes must be greater than 0: "%(minutes).1f".' % locals())
+    def neighbors(self, place):
+        return self._neighbors[place]
     
-    fonts = {}
+    def near(self, x, y, reach):
+        """ Return places that a place at x, y with the given reach might be in range of.
+        """
+        reach = max(reach, self._reach)
+        return [other for other in self._nearby(x, y, reach)
+                if hypot(other.position.x - x, other.position.y - y) <= reach]
     
-    fontfile, fontsize = opts.countryfont
+    def settled(self):
+        """ Return true if no moveable place overlaps another, so only placement energy is left to improve.
+        """
+        self._prepare()
+        
+        for place in self._moveable:
+            if self._overlap_energy(self._index[place]):
+                return False
+        
+        return True
     
-    try:
-        fontsize = int(fontsize)
-    except ValueError:
-        raise OptParseError('Bad font size for countries: "%(fontsize)s".' % locals())
+    def conflicts(self):
+        """ Return the number of pairs of neighboring places that overlap.
+        """
+        return len([(place, other) for place in self._places
+                    for other in self._neighbors[place]
+                    if id(place) < id(other) and place.overlaps(other)])
     
-    if not exists(fontfile):
-        raise OptParseError('Non-existent font filename for counties: "%(fontfile)s".' % locals())
+    def components(self):
+        """ Return lists of places connected to one another through their neighbors.
+        """
+        seen, components = set(), []
+        
+        for place in self._places:
+            if place in seen:
+                continue
+            
+            seen.add(place)
+            component, queue = [], [place]
+            
+            while queue:
+                component.append(queue.pop())
+                
+                for other in self._neighbors[component[-1]]:
+                    if other not in seen:
+                        seen.add(other)
+                        queue.append(other)
+            
+            components.append(component)
+        
+        return components
     
-    fonts['country'] = truetype(fontfile, fontsize, encoding='unic')
-
-    for opt in ('pop25mfont', 'pop250kfont', 'pop50kfont', 'popotherfont'):
-        population = opt[3:-4]
-        fontfile, fontsize = getattr(opts, opt)
+    def subset(self, places, moveable=None):
+        """ Return a new Places with just the given places and neighbors among them.
         
-        try:
-            fontsize = int(fontsize)
-        except ValueError:
-            raise OptParseError('Bad font size for population %(population)s: "%(fontsize)s".' % locals())
+            Only places in moveable will move, and it defaults to all of them.
+            Places that are not moveable here will not move in the subset.
+            The new Places shares place objects with this one, so call
+            refresh() here after changing any of them. Places keep their
+            order from here, so snapshots of a subset made the same way
+            line up between runs.
+        """
+        members = set(places)
+        moveable = set(places if moveable is None else moveable) & self._moveable_set
+        subset = Places(self._cellsize, self.focus, self.sweeps, self.patience)
+        places = [place for place in self._places if place in members]
         
-        if not exists(fontfile):
-            raise OptParseError('Non-existent font filename for population %(population)s: "%(fontfile)s".' % locals())
+        for place in places:
+            subset._places.append(place)
+            subset._neighbors[place] = self._neighbors[place] & members
         
-        fonts[population] = truetype(fontfile, fontsize, encoding='unic')
-    
-    zoom = opts.zoom
-    countriesfile = opts.countries
-    pointsfile = opts.points
-    labelsfile = opts.labels
+        subset._moveable = [place for place in places if place in moveable]
+        subset._moveable_set = set(subset._moveable)
+        subset.refresh()
+        
+        return subset
     
-    return countriesfile, inputfiles, pointsfile, labelsfile, minutes, zoom, fonts
+    def refresh(self):
+        """ Recalculate energy and label geometry after places were changed elsewhere.
+        """
+        self._energy = 0.0
+        self._counts = None
+        
+        for place in self._places:
+            self._energy += place.placement_energy()
+            
+            for other in self._neighbors[place]:
+                if id(place) < id(other):
+                    self._energy += place.overlap_energy(other)
+            
+            if self._adjacent is not None:
+                self._update(place)
+    
+    def move(self):
+        """ Move one random place, and return a token that undo() can revert.
+        """
+        self._prepare()
+        
+        place = self._choose()
+        index = self._index[place]
+        token = place, place.save(), self._energy, None, None, None
+        
+        if self.focus:
+            chance = self._chance(place)
+            neighbors, before = self._overlaps(index)
+        
+        self._energy -= self._overlap_energy(index) + place.placement_energy()
 
-def location_point(lat, lon, zoom):
-    """ Return a point that maps to pixels at the requested zoom level for 2^8 tile size.
+        place.move()
+        self._update(place)
+        
+        self._energy += self._overlap_energy(index) + place.placement_energy()
+        
+        if self.focus:
+            neighbors, after = self._overlaps(index)
+            self._recount(index, neighbors, after - before)
+            token = token[:3] + (neighbors, after - before, chance)
+        
+        return token
+    
+    def sweep(self, T):
+        """ Try a move of every moveable place at temperature T, and return the number accepted.
+        
+            Places of one color are never neighbors, so their moves change
+            the energy independently: they are all made at once, and their
+            changes in energy are found together and accepted or rejected
+            one by one by the Metropolis criterion.
+        """
+        self._prepare()
+        self._counts = None
+        
+        if self._colors is None:
+            self._color()
+        
+        accepted = 0
+        
+        for color in self._colors:
+            members = color[0]
+            places = [self._places[index] for index in members]
+            saved = [place.save() for place in places]
+            
+            before = self._color_energy(color) + [place.placement_energy() for place in places]
+            
+            for place in places:
+                place.move()
+                self._update(place)
+            
+            deltas = self._color_energy(color) + [place.placement_energy() for place in places] - before
+            chances = exp(minimum(-deltas / T, 0))
+            accepts = chances > array([random() for place in places])
+            
+            for (place, saved, accept) in zip(places, saved, accepts):
+                if not accept:
+                    place.restore(saved)
+                    self._update(place)
+            
+            self._energy += float(deltas[accepts].sum())
+            accepted += int(accepts.sum())
+        
+        return accepted
+    
+    def propose(self):
+        """ Choose a random move without making it, and return (place, candidate, delta).
+        
+            The candidate is an arrangement of the place in the form of
+            place.save(), and delta the change in energy from moving it there.
+        """
+        self._prepare()
+        
+        place = self._choose()
+        index = self._index[place]
+        candidate = place.propose()
+        
+        delta = self._overlap_energy_at(index, place, candidate) - self._overlap_energy(index) \
+              + place.placement_energy_at(candidate) - place.placement_energy()
+        
+        proposal = place, candidate, delta
+        
+        if self.focus:
+            neighbors, before = self._overlaps(index)
+            neighbors, after = self._overlaps_at(index, place, candidate)
+            ratio = self._chance_after(index, neighbors, after - before) / self._chance(place)
+            self._proposed = proposal, neighbors, after - before, ratio
+        
+        return proposal
+    
+    def proposal_bias(self, proposal):
+        """ Return the Hastings ratio for a proposal from propose(), like bias() for a move.
+        """
+        if self._proposed is None or self._proposed[0] is not proposal:
+            return 1.0
+        
+        return self._proposed[3]
+    
+    def commit(self, proposal):
+        """ Make a move from propose(), and return a proposal that would reverse it.
+        """
+        place, candidate, delta = proposal
+        index = self._index[place]
+        reverse = place, place.save(), -delta
+        
+        if self._counts is not None and self._proposed and self._proposed[0] is proposal:
+            proposal, neighbors, changes, ratio = self._proposed
+        elif self._counts is not None:
+            neighbors, before = self._overlaps(index)
+            changes = None
+        
+        place.restore(candidate)
+        self._update(place)
+        self._energy += delta
+        self._proposed = None
+        
+        if self._counts is not None:
+            if changes is None:
+                neighbors, after = self._overlaps(index)
+                changes = after - before
+            
+            self._recount(index, neighbors, changes)
+        
+        return reverse
+    
+    def bias(self, token):
+        """ Return the Hastings ratio for the move described by token.
+        
+            This is the chance of choosing the same place to move back
+            over the chance of having chosen it for this move.
+        """
+        place, saved, energy, neighbors, changes, chance = token
+        
+        if chance is None:
+            return 1.0
+        
+        return self._chance(place) / chance
+    
+    def undo(self, token):
+        """ Revert a move described by token, and return a token to redo it.
+        """
+        place, saved, energy, neighbors, changes, chance = token
+        redo = place, place.save(), self._energy, neighbors, None, None
+        
+        place.restore(saved)
+        self._update(place)
+        self._energy = energy
+        
+        if changes is not None and self._counts is not None:
+            self._recount(self._index[place], neighbors, -changes)
+            redo = redo[:4] + (-changes, None)
+        
+        return redo
+    
+    def snapshot(self):
+        """ Return a compact copy of every place's current arrangement.
+        """
+        return self._energy, [place.save() for place in self._places]
+    
+    def restore(self, snapshot):
+        """ Return every place to an arrangement from snapshot().
+        """
+        self._energy, saved = snapshot
+        self._counts = None
+        
+        for (place, saved) in zip(self._places, saved):
+            place.restore(saved)
+            
+            if self._adjacent is not None:
+                self._update(place)
+
+def state_energy(places):
+    return places.energy()
+
+def state_move(places):
+    return places.move()
+
+def state_undo(places, token):
+    return places, places.undo(token)
+
+def state_bias(places, token):
+    return places.bias(token)
+
+def state_propose(places):
+    proposal = places.propose()
+    return proposal, proposal[2], places.proposal_bias(proposal)
+
+def state_commit(places, proposal):
+    return places, places.commit(proposal)
+
+def state_done(places):
+    return places.settled()
+
+def state_sweep(places, T):
+    return places, len(places.moveable()), places.sweep(T)
+
+def state_snapshot(places):
+    return places.snapshot()
+
+def state_restore(places, snapshot):
+    places.restore(snapshot)
+    return places
+
+def anneal_places(places, minutes, replicas=1, samples=0, hot=HOT, checkpoint=None, resume=False):
+    """ Anneal places for a number of minutes, and return them with their energy.
+    
+        With a checkpoint filename, progress is saved there as it goes
+        and a resumed run picks up from it.
     """
-    try:
-        osm = Provider()
+    annealer = Annealer(state_energy, state_move, state_undo, state_snapshot, state_restore, checkpoint,
+                        bias=state_bias, sweep=places.sweeps and state_sweep or None,
+                        propose=state_propose, commit=state_commit,
+                        patience=places.patience, done=places.patience and state_done or None,
+                        metrics=record, tag=checkpoint and places_digest(places))
+    return annealer.auto(places, minutes, 50, replicas, samples, hot, resume)
+
+def anneal_snapshot(args):
+    """ Anneal places in a worker process and return the arrangements of its moveable places.
+    """
+    places, minutes, samples, hot, checkpoint, resume = args
+    
+    # pool workers are forked with their parent's random state, so each
+    # group draws its own moves
+    seed()
+    
+    places, energy = anneal_places(places, minutes, 1, samples, hot, checkpoint, resume)
+    return [place.save() for place in places.moveable()]
+
+def pack_groups(pieces, processes):
+    """ Return pieces of places packed into one group per process, balanced by weight.
+    
+        Pieces are (places, moveable, weight) tuples, and the heaviest are
+        packed first. Groups are (places, moveable) tuples of lists, with
+        no place listed twice.
+    """
+    groups = [([], []) for i in range(processes)]
+    weights = [0] * processes
+    
+    for (members, moveable, weight) in sorted(pieces, key=lambda piece: -piece[2]):
+        lightest = weights.index(min(weights))
+        groups[lightest][0].extend(members)
+        groups[lightest][1].extend(moveable)
+        weights[lightest] += weight
+    
+    return [(unique(members), unique(moveable)) for (members, moveable) in groups if members]
+
+def unique(places):
+    """ Return a list of places without repeats, in their original order.
+    """
+    seen = set()
+    return [place for place in places if not (place in seen or seen.add(place))]
+
+def group_weight(subset):
+    return len(subset.moveable()) + subset.conflicts()
+
+def anneal_subsets(subsets, minutes, processes, replicas=1, samples=0, hot=HOT, checkpoint=None, resume=False):
+    """ Anneal subsets of places in parallel, leaving the results on their places.
+    
+        Each group anneals for the full time, so bigger groups get
+        fewer moves per place. With one process the time is shared out,
+        and time left by a group that settled early goes to the rest.
+        With parallel tempering, each group uses all of its replicas'
+        processes in turn. Given a checkpoint prefix, each group keeps
+        its own numbered checkpoint file.
+    """
+    checkpoints = [checkpoint and '%s-%d.json' % (checkpoint, index) for index in range(len(subsets))]
     
-        location = Location(float(lat), float(lon))
-        coord = osm.locationCoordinate(location).zoomTo(zoom + 8)
-        point = Point(coord.column, coord.row)
+    print 'Annealing %d groups of places with %d processes' % (len(subsets), processes)
+    
+    if processes > 1 and len(subsets) > 1 and replicas == 1:
+        pool = Pool(processes)
+        snapshots = pool.map(anneal_snapshot, [(subset, minutes, samples, hot, filename, resume)
+                                               for (subset, filename) in zip(subsets, checkpoints)])
+        pool.close()
         
-        return location, point
-    except ValueError:
-        raise Exception((lat, lon, zoom))
+        # only moveable places come back, since a place frozen in the
+        # halo of one group may have been annealed in another
+        for (subset, saved) in zip(subsets, snapshots):
+            for (place, arrangement) in zip(subset.moveable(), saved):
+                place.restore(arrangement)
+    else:
+        start = time()
+        
+        for (index, (subset, filename)) in enumerate(zip(subsets, checkpoints)):
+            share = max(minutes - (time() - start) / 60, 0) / (len(subsets) - index)
+            anneal_places(subset, share, replicas, samples, hot, filename, resume)
 
-def load_places(countriesfile, inputfiles, fonts, zoom):
-    """ Load a new Places instance from the named text files for a given zoom.
+def anneal_groups(places, minutes, processes, replicas=1, samples=0, hot=HOT, checkpoint=None, resume=False):
+    """ Anneal independent groups of places in parallel, and return places.
+    
+        Neighboring places are connected into components that can never
+        interact, and these are packed into one group per process, balanced
+        by their count of moveable places and overlaps.
     """
-    osm = Provider()
-    places = Places()
-    count = 0
+    pieces = []
     
-    for row in DictReader(open(countriesfile, 'r'), dialect='excel'):
-        if int(row['zoom']) > zoom:
+    for component in places.components():
+        subset = places.subset(component)
+        
+        if len(component) == 1 or not subset.moveable():
+            # a lone place is already at its lowest energy
             continue
+        
+        pieces.append((component, subset.moveable(), group_weight(subset)))
+    
+    groups = pack_groups(pieces, replicas > 1 and 1 or processes)
+    anneal_subsets([places.subset(*group) for group in groups], minutes, processes, replicas, samples, hot, checkpoint, resume)
+    places.refresh()
+    
+    return places
 
-        location, point = location_point(row['latitude'], row['longitude'], zoom)
-        land_area = float(row['land area km'])
-        population = int(row['population'])
-        font = fonts['country']
-        
-        kwargs = {'name': row['name'].decode('utf-8'),
-                  'abbreviation': row['abbreviation'].decode('utf-8'),
-                  'land_area': land_area,
-                  'population': population,
-                  'font': font,
-                  'zoom': int(row['zoom']),
-                  
-                  'location': location,
-                  'position': point,
+def anneal_tiles(places, minutes, processes, tilesize, replicas=1, samples=0, hot=HOT, checkpoint=None, resume=False):
+    """ Anneal square tiles of places in parallel, then fix up the seams, and return places.
+    
+        Each tile of places anneals with a halo of neighbors from other tiles
+        frozen in place. Afterwards, places with neighbors in other tiles
+        anneal again together for the last part of the time, along with
+        any time the tiles did not use.
+    """
+    tiles = {}
+    
+    for place in places.moveable():
+        key = int(place.position.x // tilesize), int(place.position.y // tilesize)
+        tiles.setdefault(key, []).append(place)
+    
+    tile_keys = dict([(place, key) for (key, interior) in tiles.items() for place in interior])
+    pieces, seams = [], []
+    
+    for (key, interior) in sorted(tiles.items()):
+        halo = unique([other for place in interior for other in places.neighbors(place)
+                       if tile_keys.get(other) != key])
         
-                  # subtract two because the biggest countries appear at z3
-                  'rank': int(row['zoom']) - 2
-                 }
+        seams += [place for place in interior
+                  if [other for other in places.neighbors(place) if tile_keys.get(other, key) != key]]
         
-        neighbors = places.add(Country(**kwargs))
+        subset = places.subset(interior + halo, interior)
+        pieces.append((interior + halo, interior, group_weight(subset)))
+    
+    print 'Annealing %d tiles of %d pixels, with %d places on seams' % (len(tiles), tilesize, len(seams))
+    
+    groups, start = pack_groups(pieces, processes), time()
+    anneal_subsets([places.subset(*group) for group in groups], minutes * (1 - SEAM_TIME),
+                   processes, replicas, samples, hot, checkpoint and checkpoint + '-tiles', resume)
+    
+    halo = unique([other for place in seams for other in places.neighbors(place)])
+    anneal_groups(places.subset(unique(seams + halo), seams), max(minutes - (time() - start) / 60, minutes * SEAM_TIME),
+                  processes, replicas, samples, hot, checkpoint and checkpoint + '-seams', resume)
+    places.refresh()
+    
+    return places
+
+def postprocess_args(opts, args):
+    """ Return inputfile, pointsfile, labelsfile, minutes, zoom, fonts after optparser.parse_args().
+    """
+    try:
+        inputfiles = args[0:]
+    except IndexError:
+        raise OptParseError('Input filename is required.')
+    
+    for inputfile in inputfiles:
+        if not exists(inputfile):
+            raise OptParseError('Non-existent input filename: "%(inputfile)s".' % locals())
+
+    minutes = opts.minutes
+
+    if minutes <= 0:
+        raise OptParseError('Minutes must be greater than 0: "%(minutes).1f".' % locals())
+    
+    processes = opts.processes
+    
+    if processes <= 0:
+        raise OptParseError('Processes must be greater than 0: "%(processes)d".' % locals())
+    
+    tilesize = opts.tilesize
+    
+    if tilesize < 0:
+        raise OptParseError('Tile size must not be negative: "%(tilesize)d".' % locals())
+    
+    replicas = opts.replicas
+    
+    if replicas <= 0:
+        raise OptParseError('Replicas must be greater than 0: "%(replicas)d".' % locals())
+    
+    samples = opts.samples
+    
+    if samples < 0:
+        raise OptParseError('Samples must not be negative: "%(samples)d".' % locals())
+    
+    patience = opts.patience
+    
+    if patience < 0:
+        raise OptParseError('Patience must not be negative: "%(patience).2f".' % locals())
+    
+    focus = opts.focus
+    
+    if focus < 0 or focus >= 1:
+        raise OptParseError('Focus must be at least 0 and less than 1: "%(focus).2f".' % locals())
+    
+    seed = opts.seed
+    
+    if seed and not exists(seed):
+        raise OptParseError('Non-existent seed filename: "%(seed)s".' % locals())
+    
+    if seed and splitext(seed)[1] not in ('.shp', '.json', '.geojson'):
+        raise OptParseError('Seed must be GeoJSON or a shapefile ending in .shp: "%(seed)s".' % locals())
+    
+    fonts = {}
+    font_metrics = FontMetrics(opts.fontmetrics)
+    
+    fontfile, fontsize = opts.countryfont
+    
+    try:
+        fontsize = int(fontsize)
+    except ValueError:
+        raise OptParseError('Bad font size for countries: "%(fontsize)s".' % locals())
+    
+    if not exists(fontfile):
+        raise OptParseError('Non-existent font filename for counties: "%(fontfile)s".' % locals())
+    
+    fonts['country'] = font_metrics.font(fontfile, fontsize)
+
+    for opt in ('pop25mfont', 'pop250kfont', 'pop50kfont', 'popotherfont'):
+        population = opt[3:-4]
+        fontfile, fontsize = getattr(opts, opt)
         
-        count += 1
-        print '%5d)' % count, row['name'], location, point
+        try:
+            fontsize = int(fontsize)
+        except ValueError:
+            raise OptParseError('Bad font size for population %(population)s: "%(fontsize)s".' % locals())
         
-        if neighbors:
-            print '       is in range of', ', '.join([n.name for n in neighbors])
+        if not exists(fontfile):
+            raise OptParseError('Non-existent font filename for population %(population)s: "%(fontfile)s".' % locals())
+        
+        fonts[population] = font_metrics.font(fontfile, fontsize)
     
-    for inputfile in inputfiles:
+    zoom = opts.zoom
+    countriesfile = opts.countries
+    pointsfile = opts.points
+    labelsfile = opts.labels
     
-        input = inputfile.endswith('.gz') and GzipFile(inputfile, 'r') or open(inputfile, 'r')
+    return countriesfile, inputfiles, pointsfile, labelsfile, minutes, zoom, fonts
+
+def location_points(lats, lons, zoom):
+    """ Return locations and points that map to pixels at the requested zoom level for 2^8 tile size.
     
-        for row in DictReader(input, dialect='excel-tab'):
-            if int(row['zoom']) > zoom:
-                continue
+        Latitudes and longitudes are whole columns, projected all at once.
+    """
+    xs, ys = project(lats, lons, zoom)
+    
+    locations = [Location(lat, lon) for (lat, lon) in zip(lats.tolist(), lons.tolist())]
+    points = [Point(x, y) for (x, y) in zip(xs.tolist(), ys.tolist())]
+    
+    return locations, points
 
-            location, point = location_point(row['latitude'], row['longitude'], zoom)
+def load_places(countriesfile, inputfiles, fonts, zoom, cachedir='input-cache'):
+    """ Load a new Places instance from the named text files for a given zoom.
+    
+        Inputs are read from columns cached in cachedir, parsed again only
+        when they change. Fonts are MeasuredFont instances; all the names are
+        measured in one go before any places are made, and the font metrics cache saved.
+    """
+    phases = Phases()
+    
+    # grid cells about the size of a long label in the largest font
+    cellsize = max([hypot(*font.getsize(u'M' * 12)) for font in fonts.values()])
+    places = Places(cellsize)
+    rows, lats, lons = [], [], []
+    
+    columns = open_columns(countriesfile, cachedir)
+    count = columns.count(zoom)
+    
+    names, abbreviations = columns.texts('name', count), columns.texts('abbreviation', count)
+    zooms, populations = columns.numbers('zoom')[:count].tolist(), columns.numbers('population')[:count].tolist()
+    land_areas = columns.numbers('land area km')[:count].tolist()
+    
+    for i in range(count):
+        kwargs = {'name': names[i],
+                  'abbreviation': abbreviations[i],
+                  'land_area': land_areas[i],
+                  'population': populations[i],
+                  'font': fonts['country'],
+                  'zoom': zooms[i],
+        
+                  # subtract two because the biggest countries appear at z3
+                  'rank': zooms[i] - 2
+                 }
+        
+        rows.append((Country, kwargs))
+    
+    lats.append(columns.numbers('latitude')[:count])
+    lons.append(columns.numbers('longitude')[:count])
+    
+    for inputfile in inputfiles:
+        columns = open_columns(inputfile, cachedir)
+        count = columns.count(zoom)
+        
+        names, geonameids = columns.texts('name', count), columns.strings('geonameid', count)
+        zooms, populations = columns.numbers('zoom')[:count].tolist(), columns.numbers('population')[:count].tolist()
+    
+        for i in range(count):
+            population = populations[i]
             
-            try:
-                population = int(row['population'])
-            except ValueError:
+            if population == NO_POPULATION:
                 population = None
 
             if population >= 2500000:
@@ -554,122 +1581,300 @@ def load_places(countriesfile, inputfiles, fonts, zoom):
             else:
                 font = fonts['other']
             
-            kwargs = {'name': row['name'].decode('utf-8'),
+            kwargs = {'name': names[i],
                       'population': population,
                       'font': font,
-                      'zoom': int(row['zoom']),
+                      'zoom': zooms[i],
                       
-                      'geonameid': row['geonameid'],
-                      'location': location,
-                      'position': point,
+                      'geonameid': geonameids[i],
             
                       # subtract three because the biggest cities appear at z4
-                      'rank': int(row['zoom']) - 3
+                      'rank': zooms[i] - 3
                      }
             
-            if zoom >= 9:
-                neighbors = places.add(HighZoomCity(**kwargs))
-            else:
-                neighbors = places.add(City(**kwargs))
-            
-            count += 1
-            print '%5d)' % count, row['name'], location, point
-            
-            if neighbors:
-                print '       is in range of', ', '.join([n.name for n in neighbors])
+            rows.append((zoom >= 9 and HighZoomCity or City, kwargs))
+    
+        lats.append(columns.numbers('latitude')[:count])
+        lons.append(columns.numbers('longitude')[:count])
+    
+    phases.done('parse', places=len(rows))
+    
+    locations, points = location_points(concatenate(lats), concatenate(lons), zoom)
+    
+    for ((cls, kwargs), location, point) in zip(rows, locations, points):
+        kwargs.update(location=location, position=point)
+    
+    phases.done('project', places=len(rows))
+    
+    for font in set(fonts.values()):
+        font.measure([kwargs[key] for (cls, kwargs) in rows if kwargs['font'] is font
+                      for key in ('name', 'abbreviation') if key in kwargs])
+    
+    for font_metrics in set([font.font_metrics for font in fonts.values()]):
+        font_metrics.save()
+    
+    phases.done('font sizing', places=len(rows))
+    
+    for (count, (cls, kwargs)) in enumerate(rows):
+        neighbors = places.add(cls(**kwargs))
+        
+        if not verbose():
+            continue
+        
+        print '%5d)' % (count + 1), kwargs['name'].encode('utf-8'), kwargs['location'], kwargs['position']
+        
+        if neighbors:
+            print '       is in range of', ', '.join([n.name for n in neighbors]).encode('utf-8')
+    
+    phases.done('graph build', places=len(rows), moveable=len(places._moveable))
     
     return places
 
-def bbox_polygon(bbox, provider, zoom):
+def seed_places(places, labelsfile, zoom):
+    """ Start places from the labels of another zoom level, and return how many matched.
+    
+        Labels are GeoJSON or a shapefile written by write_places(). Cities
+        are matched by geonameid and take the placement facing the same way
+        as their old label. Countries are matched by name or abbreviation,
+        and they and high-zoom cities move as near to their old label as
+        they can go.
+    """
+    if labelsfile.endswith('.shp'):
+        features = read_features(labelsfile)
+    else:
+        features = loadjson(open(labelsfile))['features']
+    
+    cities, countries = {}, {}
+    
+    for feature in features:
+        properties = feature['properties']
+        
+        if properties['place'] == 'country':
+            countries[properties['name']] = feature
+        else:
+            cities[properties['geonameid']] = feature
+    
+    seeded = 0
+    
+    for place in places:
+        if place.__class__ is Country:
+            feature = countries.get(place.name, countries.get(place.abbr))
+        else:
+            feature = cities.get(place.geonameid)
+        
+        if feature is None:
+            continue
+        
+        lons, lats = zip(*feature['geometry']['coordinates'][0])
+        xs, ys = project(lats, lons, zoom)
+        bbox = xs.min(), ys.min(), xs.max(), ys.max()
+        
+        if place.__class__ is Country:
+            place.seed(bbox, place.name not in countries)
+        else:
+            place.seed(bbox)
+        
+        seeded += 1
+    
+    places.refresh()
+    
+    return seeded
 
-    rectangle = bbox.envelope.exterior
-    (x1, y1), (x2, y2) = rectangle.coords[0], rectangle.coords[2]
+def place_key(place):
+    """ Return a key for a place that stays the same from one run to the next.
+    """
+    if place.__class__ is Country:
+        return u'country:' + place.name
+    
+    return place.geonameid
 
-    coord1 = Coordinate(y1, x1, zoom + 8)
-    coord2 = Coordinate(y2, x2, zoom + 8)
+def place_fingerprint(place):
+    """ Return a list of everything about a place that its arrangement depends on.
+    """
+    return [place.name, place.rank, place.population, place.location.lat, place.location.lon, place.reach()]
 
-    location1 = provider.coordinateLocation(coord1)
-    location2 = provider.coordinateLocation(coord2)
+def places_digest(places):
+    """ Return the count of places and an MD5 digest of their keys and fingerprints, in order.
     
-    lat1, lon1 = location1.lat, location1.lon
-    lat2, lon2 = location2.lat, location2.lon
-    
-    return Polygon(((lon1, lat1), (lon1, lat2), (lon2, lat2), (lon2, lat1), (lon1, lat1)))
+        Saved arrangements only fit places with the same digest.
+    """
+    keys = [(place_key(place), place_fingerprint(place)) for place in places]
+    return [len(keys), md5(dumps(keys)).hexdigest()]
 
-if __name__ == '__main__':
+def save_state(places, zoom, statefile):
+    """ Save the arrangement of places to a JSON file for restore_state() in a later run.
+    """
+    state = dict([(place_key(place), {'fingerprint': place_fingerprint(place), 'saved': place.save()})
+                  for place in places])
     
-    opts, args = optparser.parse_args()
-    countriesfile, inputfiles, pointsfile, labelsfile, minutes, zoom, fonts \
-        = postprocess_args(opts, args)
+    count, digest = places_digest(places)
+    dumpjson({'zoom': zoom, 'count': count, 'digest': digest, 'places': state}, open(statefile, 'w'))
 
-    capitals = set( [geonameid.strip() for geonameid in open('Capitals.txt')] )
-    places = load_places(countriesfile, inputfiles, fonts, zoom)
+def restore_state(places, statefile, zoom):
+    """ Restore places unchanged since a saved state, and return a list of places to arrange again.
+    
+        Places are new or changed if their fingerprint differs. Those, and
+        any places in range of where changed or removed places used to be,
+        need arranging again; all the others get their saved arrangement.
+        Places are matched by key, never by order, so a count or digest
+        that differs from the saved one only means some places changed.
+    """
+    state = loadjson(open(statefile))
+    
+    if state.get('zoom') != zoom or 'places' not in state:
+        return list(places)
+    
+    if [state.get('count'), state.get('digest')] != places_digest(places):
+        print 'Places changed since %s was saved' % statefile
+    
+    saved, touched, keys = state['places'], [], set()
+    
+    for place in places:
+        key = place_key(place)
+        keys.add(key)
+        
+        if key in saved and saved[key]['fingerprint'] == place_fingerprint(place):
+            place.restore(saved[key]['saved'])
+        else:
+            touched.append(place)
+    
+    # places near where others were may have room to move now
+    keys -= set([place_key(place) for place in touched])
+    gone = [saved[key]['fingerprint'] for key in saved if key not in keys]
+    
+    if gone:
+        xs, ys = project([fingerprint[3] for fingerprint in gone], [fingerprint[4] for fingerprint in gone], zoom)
+        
+        for (x, y, fingerprint) in zip(xs, ys, gone):
+            touched.extend(places.near(x, y, fingerprint[5]))
+    
+    places.refresh()
+    
+    return unique(touched)
 
-    print '-' * 80
+def anneal_touched(places, touched, minutes, processes, replicas=1, samples=0, hot=HOT, checkpoint=None, resume=False):
+    """ Anneal just the groups of places with any touched places in them, and return places.
+    
+        Time is cut to the share of all moveable places that are annealed.
+    """
+    touched = set(touched)
+    members = [place for component in places.components()
+               for place in (touched.intersection(component) and component or [])]
+    
+    moveable = places.subset(members).moveable()
     
-    print len(places._moveable), 'moveable places vs.', len(places._places), 'others'
+    print 'Arranging %d of %d moveable places again' % (len(moveable), len(places.moveable()))
+    
+    if moveable:
+        share = float(len(moveable)) / len(places.moveable())
+        anneal_groups(places.subset(members), minutes * share, processes, replicas, samples, hot, checkpoint, resume)
+        places.refresh()
+    
+    return places
 
-    print '-' * 80
+def remove_checkpoints(checkpoint):
+    """ Remove every checkpoint file with a prefix, once its run is written out.
+    """
+    for filename in glob(checkpoint + '-*.json'):
+        remove(filename)
+
+def bbox_polygon(bbox, zoom):
+    """ Return a geographic shapely Polygon for a pixel bounding box at the given zoom.
+    """
+    x1, y1, x2, y2 = bbox
+
+    (lat1, lat2), (lon1, lon2) = [column.tolist() for column in unproject((x1, x2), (y1, y2), zoom)]
     
-    def state_energy(places):
-        return places.energy()
+    return Polygon(((lon1, lat1), (lon1, lat2), (lon2, lat2), (lon2, lat1), (lon1, lat1)))
 
-    def state_move(places):
-        places.move()
+def write_geojson(filename, geometries, properties_list):
+    """ Write a GeoJSON file of features, one per line, and return the (offset, length) of each.
+    """
+    file = open(filename, 'w')
+    file.write('{"type": "FeatureCollection", "features": [\n')
+    spans, separator = [], ''
+    
+    for (geometry, properties) in zip(geometries, properties_list):
+        feature = dumps({'type': 'Feature', 'geometry': geometry, 'properties': properties})
+        file.write(separator)
+        spans.append((file.tell(), len(feature)))
+        file.write(feature)
+        separator = ',\n'
     
-    places, e = Annealer(state_energy, state_move).auto(places, minutes, 50)
+    file.write('\n]}\n')
+    file.close()
+    
+    return spans
 
-    print '-' * 80
+def write_places(places, zoom, pointsfile, labelsfile, capitals, hilbert=False):
+    """ Write visible places to files of points and labels, and return them.
     
-    osm = Provider()
-    point_features, label_features = [], []
+        Places are visited from most to least important, and any that
+        overlap a place already written are skipped. Files are GeoJSON,
+        or shapefiles with a Mapnik spatial index for names ending in .shp.
+        
+        With hilbert, places are written in order along a Hilbert curve,
+        and each file gets an index of its byte ranges in each tile.
+    """
+    phases = Phases()
+    properties_list, points, rings = [], [], []
     visible_places = []
     
-    for place in sorted(places):
+    ordered = sorted(places)
+    blockers = cull([(place.label_bbox(), place.mask_shape()) for place in ordered])
     
-        is_visible = True
-        
-        for other in visible_places:
-            if place.overlaps(other):
-                print 'skip', place.name, 'because of', other.name
-                is_visible = False
-                break
-        
-        if not is_visible:
+    for (place, blocker) in zip(ordered, blockers):
+    
+        if blocker is not None:
+            if verbose():
+                print 'skip', place.name.encode('utf-8'), 'because of', ordered[blocker].name.encode('utf-8')
             continue
         
         visible_places.append(place)
         
-        properties = {'name': unicode(place),
-                      'rank': place.rank,
-                      'population': place.population,
-                      'geonameid': getattr(place, 'geonameid', None),
-                      'capital': (getattr(place, 'geonameid', '') in capitals and 'yes' or 'no'),
-                      'place': (place.__class__ is Country and 'country' or 'city')
-                     }
-    
-        location = place.location
-        point_geometry = {'type': 'Point', 'coordinates': (location.lon, location.lat)}
-        
-        point_features.append({'type': 'Feature',
-                               'geometry': point_geometry,
-                               'properties': properties
-                              })
-        
-        label_geometry = bbox_polygon(place.label_bbox(), osm, zoom).__geo_interface__
-        
-        label_features.append({'type': 'Feature',
-                               'geometry': label_geometry,
-                               'properties': properties
-                              })
-    
-    dumpjson({'type': 'FeatureCollection', 'features': point_features}, open(pointsfile, 'w'))
-    dumpjson({'type': 'FeatureCollection', 'features': label_features}, open(labelsfile, 'w'))
-    
-    print 'Wrote %d points to %s and %s.' % (len(point_features), pointsfile, labelsfile)
-    
-    print '-' * 80
-    
+        properties_list.append({'name': unicode(place),
+                                'rank': place.rank,
+                                'population': place.population,
+                                'geonameid': getattr(place, 'geonameid', None),
+                                'capital': (getattr(place, 'geonameid', '') in capitals and 'yes' or 'no'),
+                                'place': (place.__class__ is Country and 'country' or 'city')
+                               })
+    
+        points.append((place.location.lon, place.location.lat))
+        rings.append(list(bbox_polygon(place.label_bbox(), zoom).exterior.coords))
+    
+    phases.done('cull', places=len(ordered), visible=len(visible_places))
+    
+    if hilbert:
+        order = hilbert_order([place.label_bbox() for place in visible_places], zoom)
+        visible_places, properties_list, points, rings \
+            = [[items[index] for index in order] for items in (visible_places, properties_list, points, rings)]
+    
+    if pointsfile.endswith('.shp'):
+        point_spans = write_points(pointsfile, points, properties_list, SHAPEFILE_FIELDS)
+    else:
+        point_spans = write_geojson(pointsfile, [{'type': 'Point', 'coordinates': point} for point in points], properties_list)
+    
+    if labelsfile.endswith('.shp'):
+        # shapefile outer rings go clockwise, the other way from bbox_polygon()
+        label_spans = write_polygons(labelsfile, [ring[::-1] for ring in rings], properties_list, SHAPEFILE_FIELDS)
+    else:
+        label_spans = write_geojson(labelsfile, [{'type': 'Polygon', 'coordinates': (tuple(ring), )} for ring in rings], properties_list)
+    
+    if hilbert:
+        xs, ys = project([lat for (lon, lat) in points], [lon for (lon, lat) in points], zoom)
+        write_tile_index(splitext(pointsfile)[0] + '-tiles.json', zip(xs, ys, xs, ys), point_spans, zoom)
+        write_tile_index(splitext(labelsfile)[0] + '-tiles.json', [place.label_bbox() for place in visible_places], label_spans, zoom)
+    
+    phases.done('write', places=len(visible_places))
+    
+    return visible_places
+
+def save_preview(visible_places, zoom, fonts, filename):
+    """ Draw visible places over a map for the given zoom and save it to an image file.
+    """
+    phases = Phases()
+    osm = Provider()
     map = mapByCenterZoom(osm, Location(0, 0), zoom, Point(2 ** (zoom + 8), 2 ** (zoom + 8)))
     
     if zoom > 5:
@@ -689,9 +1894,9 @@ if __name__ == '__main__':
                         and sw.lon < place.location.lon and place.location.lon < ne.lon)]
     
     for place in previewed_places:
-        box = place.label_bbox().envelope.exterior
-        coord1 = Coordinate(box.coords[0][1], box.coords[0][0], zoom + 8)
-        coord2 = Coordinate(box.coords[2][1], box.coords[2][0], zoom + 8)
+        x1, y1, x2, y2 = place.label_bbox()
+        coord1 = Coordinate(y1, x1, zoom + 8)
+        coord2 = Coordinate(y2, x2, zoom + 8)
         
         loc1, loc2 = osm.coordinateLocation(coord1), osm.coordinateLocation(coord2)
         point1, point2 = map.locationPoint(loc1), map.locationPoint(loc2)
@@ -715,8 +1920,9 @@ if __name__ == '__main__':
         draw.rectangle((point.x-1, point.y-1, point.x+1, point.y+1), fill=color)
 
     for place in previewed_places:
-        box = place.label_bbox().exterior
-        coords = [Coordinate(c[1], c[0], zoom + 8) for c in box.coords]
+        x1, y1, x2, y2 = place.label_bbox()
+        corners = ((x1, y1), (x1, y2), (x2, y2), (x2, y1))
+        coords = [Coordinate(y, x, zoom + 8) for (x, y) in corners]
         locations = [osm.coordinateLocation(coord) for coord in coords]
         points = [map.locationPoint(location) for location in locations]
         
@@ -736,6 +1942,222 @@ if __name__ == '__main__':
         
         draw.text((x, y), unicode(place), font=font, fill=(0x00, 0x00, 0x00))
 
-    img.save('out.png')
+    img.save(filename)
+    phases.done('preview', places=len(previewed_places))
+    
+    print 'Saved preview map to %s.' % filename
+
+def load_config(filename, zooms):
+    """ Return a list of jobs from a JSON config file, for zooms in a range like "3-11".
+    
+        The file has a "jobs" list, each one a dictionary with zoom, minutes,
+        countries, inputs, points and labels, and optionally tilesize, focus,
+        sweeps, patience, hilbert and fonts. Fonts map country, 25m, 250k, 50k and other to a filename and
+        size, with filenames relative to a top-level "fonts" directory.
+        Zero minutes means no annealing at all.
+    """
+    try:
+        config = loadjson(open(filename))
+    except ValueError, e:
+        raise OptParseError('Bad config file "%(filename)s": %(e)s.' % locals())
+    
+    try:
+        low, high = [int(zoom) for zoom in (zooms + '-' + zooms).split('-')[:2]]
+    except ValueError:
+        raise OptParseError('Bad zoom range: "%(zooms)s".' % locals())
+    
+    fontdir = config.get('fonts', '.')
+    jobs = []
+    
+    for job in config['jobs']:
+        if job['zoom'] < low or high < job['zoom']:
+            continue
+        
+        fonts = {}
+        
+        for (population, opt) in zip(('country', '25m', '250k', '50k', 'other'),
+                                     ('countryfont', 'pop25mfont', 'pop250kfont', 'pop50kfont', 'popotherfont')):
+            fontfile, fontsize = job.get('fonts', {}).get(population, defaults[opt])
+            
+            if population in job.get('fonts', {}):
+                fontfile = join(fontdir, fontfile)
+            
+            if not exists(fontfile):
+                raise OptParseError('Non-existent font filename for z%d %s: "%s".' % (job['zoom'], population, fontfile))
+            
+            fonts[population] = fontfile, int(fontsize)
+        
+        for inputfile in [job['countries']] + job['inputs']:
+            if not exists(inputfile):
+                raise OptParseError('Non-existent input filename for z%d: "%s".' % (job['zoom'], inputfile))
+        
+        jobs.append(dict(job, fonts=fonts, tilesize=job.get('tilesize', 0),
+                         focus=job.get('focus', defaults['focus']), sweeps=job.get('sweeps', defaults['sweeps']),
+                         patience=job.get('patience', defaults['patience']),
+                         hilbert=job.get('hilbert', defaults['hilbert'])))
+    
+    return jobs
+
+def arrange_zoom(args):
+    """ Load, anneal and write the places for one job of a config file, and return its summary.
+    
+        Runs in a worker process of its own, so it anneals with just one.
+    """
+    job, fontmetricsfile, cachedir, samples, incremental, resume = args
+    
+    font_metrics = FontMetrics(fontmetricsfile)
+    fonts = dict([(key, font_metrics.font(*font)) for (key, font) in job['fonts'].items()])
+    
+    zoom, minutes = job['zoom'], job['minutes']
+    set_context(zoom=zoom)
+    places = load_places(job['countries'], job['inputs'], fonts, zoom, cachedir)
+    places.focus, places.sweeps, places.patience = job['focus'], job['sweeps'], job['patience']
+    statefile = splitext(job['labels'])[0] + '-state.json'
+    checkpoint = splitext(job['labels'])[0] + '-checkpoint'
+    
+    start, phases = time(), Phases()
+    
+    if minutes > 0 and incremental and exists(statefile):
+        touched = restore_state(places, statefile, zoom)
+        places = anneal_touched(places, touched, minutes, 1, 1, samples, HOT, checkpoint, resume)
+    elif minutes > 0 and job['tilesize']:
+        places = anneal_tiles(places, minutes, 1, job['tilesize'], 1, samples, HOT, checkpoint, resume)
+    elif minutes > 0:
+        places = anneal_groups(places, minutes, 1, 1, samples, HOT, checkpoint, resume)
+    
+    while minutes > 0:
+        # give away time left after settling early, or else take more
+        spare = minutes - (time() - start) / 60
+        
+        if spare > minutes * SETTLED_TIME:
+            spare_time(spare, True)
+            break
+        
+        minutes, start = spare_time(0), time()
+        
+        if minutes < SPARE_TIME:
+            spare_time(minutes, True)
+            break
+        
+        print 'Arranging z%d again for %.1f spare minutes' % (zoom, minutes)
+        places = anneal_groups(places, minutes, 1, 1, samples, SEEDED_HOT)
+
+    phases.done('anneal', minutes=job['minutes'])
+    
+    capitals = set( [geonameid.strip() for geonameid in open('Capitals.txt')] )
+    visible_places = write_places(places, zoom, job['points'], job['labels'], capitals, job['hilbert'])
+    save_state(places, zoom, statefile)
+    remove_checkpoints(checkpoint)
+    
+    return zoom, len(visible_places), job['points'], job['labels']
+
+def share_spare_time(spare):
+    """ Keep an Array of spare minutes and unfinished jobs for spare_time(), in each worker.
+    """
+    global _spare
+    _spare = spare
+
+def spare_time(minutes, finished=False):
+    """ Add minutes to the spare time shared between jobs, and return a share of it.
+    
+        Jobs that settle early give their time back as they finish. Jobs
+        still improving when their time is up ask for an even share of the
+        spare time among all unfinished jobs, with zero minutes.
+    """
+    if _spare is None:
+        return 0.0
+    
+    with _spare.get_lock():
+        _spare[0] += minutes
+        _spare[1] -= int(finished)
+        share = (not finished) and _spare[0] / max(_spare[1], 1) or 0.0
+        _spare[0] -= share
+    
+    return share
+
+def arrange_zooms(jobs, processes, fontmetricsfile, cachedir, samples, incremental=False, resume=False):
+    """ Run a list of jobs from a config file in a pool of processes, longest first.
+    
+        Every input is parsed into the columns cache here first, so the
+        workers share one parse of each file and only map its columns.
+        Time that a job leaves when it settles early goes to jobs that
+        are still improving when their own time is up.
+    """
+    for inputfile in unique([job['countries'] for job in jobs] + [file for job in jobs for file in job['inputs']]):
+        open_columns(inputfile, cachedir)
+    
+    jobs = sorted(jobs, key=lambda job: -job['minutes'])
+    arguments = [(job, fontmetricsfile, cachedir, samples, incremental, resume) for job in jobs]
+    
+    print 'Arranging %d zooms with %d processes' % (len(jobs), min(processes, len(jobs)))
+    
+    spare = Array('d', [0.0, len([job for job in jobs if job['minutes'] > 0])])
+    
+    if processes > 1 and len(jobs) > 1:
+        pool = Pool(min(processes, len(jobs)), share_spare_time, (spare, ))
+        results = pool.map(arrange_zoom, arguments, 1)
+        pool.close()
+    else:
+        share_spare_time(spare)
+        results = map(arrange_zoom, arguments)
+    
+    print '-' * 80
+    
+    for (zoom, count, pointsfile, labelsfile) in sorted(results):
+        print 'Wrote %d z%d points to %s and %s.' % (count, zoom, pointsfile, labelsfile)
+
+if __name__ == '__main__':
     
-    print 'Saved preview map to out.png.'
+    opts, args = optparser.parse_args()
+    setup_telemetry(opts.metrics, opts.verbose)
+    
+    if opts.config:
+        jobs = load_config(opts.config, opts.zooms)
+        arrange_zooms(jobs, opts.processes, opts.fontmetrics, opts.inputcache, opts.samples, opts.incremental, opts.resume)
+    
+    else:
+        countriesfile, inputfiles, pointsfile, labelsfile, minutes, zoom, fonts \
+            = postprocess_args(opts, args)
+
+        set_context(zoom=zoom)
+        places = load_places(countriesfile, inputfiles, fonts, zoom, opts.inputcache)
+        places.focus, places.sweeps, places.patience = opts.focus, opts.sweeps, opts.patience
+
+        print '-' * 80
+        
+        print len(places._moveable), 'moveable places vs.', len(places._places), 'others'
+
+        hot = HOT
+
+        if opts.seed:
+            print 'Seeded %d places from %s' % (seed_places(places, opts.seed, zoom), opts.seed)
+            hot = SEEDED_HOT
+
+        print '-' * 80
+        
+        statefile = splitext(labelsfile)[0] + '-state.json'
+        checkpoint = splitext(labelsfile)[0] + '-checkpoint'
+        phases = Phases()
+
+        if opts.incremental and exists(statefile):
+            touched = restore_state(places, statefile, zoom)
+            places = anneal_touched(places, touched, minutes, opts.processes, opts.replicas, opts.samples, hot, checkpoint, opts.resume)
+        elif opts.tilesize:
+            places = anneal_tiles(places, minutes, opts.processes, opts.tilesize, opts.replicas, opts.samples, hot, checkpoint, opts.resume)
+        else:
+            places = anneal_groups(places, minutes, opts.processes, opts.replicas, opts.samples, hot, checkpoint, opts.resume)
+
+        phases.done('anneal', minutes=minutes)
+
+        print '-' * 80
+        
+        capitals = set( [geonameid.strip() for geonameid in open('Capitals.txt')] )
+        visible_places = write_places(places, zoom, pointsfile, labelsfile, capitals, opts.hilbert)
+        save_state(places, zoom, statefile)
+        remove_checkpoints(checkpoint)
+        
+        print 'Wrote %d points to %s and %s.' % (len(visible_places), pointsfile, labelsfile)
+        
+        print '-' * 80
+        
+        save_preview(visible_places, zoom, fonts, 'out.png')
@@ -0,0 +1,158 @@
+""" Parsed input files, cached on disk as memory-mapped numpy columns.
+
+Each input file of countries or cities is parsed once into a directory of
+.npy files, one per column, with rows sorted by zoom so that the places for
+any zoom level are a prefix of every column. Text columns are kept as one
+array of UTF-8 bytes plus an array of offsets into it.
+
+Cache directories are named for the MD5 hash of the input, and a small JSON
+file per input remembers which hash goes with which modification time and
+size, so unchanged inputs are not even rehashed.
+"""
+from os import stat, rename, makedirs, getpid
+from os.path import exists, join, basename
+from csv import DictReader
+from gzip import GzipFile
+from hashlib import md5
+from shutil import rmtree
+from json import load as loadjson, dump as dumpjson
+
+from numpy import array, load, save, searchsorted, cumsum, concatenate, frombuffer, uint8
+
+# missing populations are stored as this, and read back as None
+NO_POPULATION = -1
+
+# (column, type, missing) for the number columns of each kind of input
+COUNTRY_NUMBERS = [('zoom', int, None), ('latitude', float, None), ('longitude', float, None),
+                   ('population', int, None), ('land area km', float, None)]
+
+CITY_NUMBERS = [('zoom', int, None), ('latitude', float, None), ('longitude', float, None),
+                ('population', int, NO_POPULATION)]
+
+COUNTRY_TEXTS = ['name', 'abbreviation']
+CITY_TEXTS = ['name', 'geonameid']
+
+class Columns:
+    """ Memory-mapped columns of one input file, sorted by zoom.
+    """
+    def __init__(self, dirname):
+        self._dirname = dirname
+        self._arrays = {}
+        self.zoom = self.numbers('zoom')
+
+    def __len__(self):
+        return len(self.zoom)
+
+    def _array(self, name):
+        if name not in self._arrays:
+            filename = join(self._dirname, name.replace(' ', '-') + '.npy')
+            self._arrays[name] = load(filename, mmap_mode='r')
+
+        return self._arrays[name]
+
+    def count(self, zoom):
+        """ Return the number of rows at or below a zoom level.
+        """
+        return int(searchsorted(self.zoom, zoom, 'right'))
+
+    def numbers(self, name):
+        """ Return an array of one number column.
+        """
+        return self._array(name)
+
+    def strings(self, name, count):
+        """ Return a list of the first count values of one text column, as bytes.
+        """
+        blob, offsets = self._array(name + '-text'), self._array(name + '-offsets')
+        text, offsets = blob[:offsets[count]].tostring(), offsets[:count + 1].tolist()
+
+        return [text[offsets[i]:offsets[i+1]] for i in range(count)]
+
+    def texts(self, name, count):
+        """ Return a list of the first count values of one text column, decoded.
+        """
+        return [string.decode('utf-8') for string in self.strings(name, count)]
+
+def open_columns(filename, cachedir):
+    """ Return Columns for an input file, parsing it into the cache first if it has changed.
+    """
+    if not exists(cachedir):
+        try:
+            makedirs(cachedir)
+        except OSError:
+            # another run may have just made it
+            pass
+
+    status = stat(filename)
+    version = {'mtime': status.st_mtime, 'size': status.st_size}
+    indexfile = join(cachedir, basename(filename) + '.json')
+
+    try:
+        index = loadjson(open(indexfile))
+    except (IOError, ValueError):
+        index = {}
+
+    if dict([(key, index.get(key)) for key in version]) != version:
+        index = dict(version, md5=md5(open(filename, 'rb').read()).hexdigest())
+
+        if not exists(join(cachedir, index_dirname(filename, index))):
+            build_columns(filename, join(cachedir, index_dirname(filename, index)))
+
+        temporary = '%s.%d' % (indexfile, getpid())
+        file = open(temporary, 'w')
+        dumpjson(index, file)
+        file.close()
+        rename(temporary, indexfile)
+
+    return Columns(join(cachedir, index_dirname(filename, index)))
+
+def index_dirname(filename, index):
+    return '%s-%s' % (basename(filename), index['md5'])
+
+def build_columns(filename, dirname):
+    """ Parse an input file into a new cache directory of columns.
+    """
+    if filename.endswith('.csv'):
+        rows = DictReader(open(filename, 'r'), dialect='excel')
+        numbers, texts = COUNTRY_NUMBERS, COUNTRY_TEXTS
+    else:
+        input = filename.endswith('.gz') and GzipFile(filename, 'r') or open(filename, 'r')
+        rows = DictReader(input, dialect='excel-tab')
+        numbers, texts = CITY_NUMBERS, CITY_TEXTS
+
+    columns = dict([(name, []) for (name, type, missing) in numbers] + [(name, []) for name in texts])
+
+    for row in rows:
+        for (name, type, missing) in numbers:
+            try:
+                columns[name].append(type(row[name]))
+            except ValueError:
+                if missing is None:
+                    raise Exception((filename, name, row[name]))
+                columns[name].append(missing)
+
+        for name in texts:
+            columns[name].append(row[name])
+
+    # a stable sort, to keep the order of places within each zoom level
+    order = array(columns['zoom'], dtype=int).argsort(kind='mergesort')
+
+    temporary = '%s.%d' % (dirname, getpid())
+    makedirs(temporary)
+
+    for (name, type, missing) in numbers:
+        save(join(temporary, name.replace(' ', '-') + '.npy'), array(columns[name])[order])
+
+    for name in texts:
+        values = [columns[name][i] for i in order]
+        lengths = [len(value) for value in values]
+        offsets = concatenate(([0], cumsum(lengths, dtype=int)))
+
+        save(join(temporary, name + '-text.npy'), frombuffer(''.join(values) or '\0', dtype=uint8))
+        save(join(temporary, name + '-offsets.npy'), offsets)
+
+    try:
+        rename(temporary, dirname)
+    except OSError:
+        # another run built the same columns first
+        rmtree(temporary)
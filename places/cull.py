@@ -0,0 +1,134 @@
+""" Greedy culling of overlapping labels, with a grid index of the labels kept.
+
+Labels are visited from most to least important, and each is kept unless
+it overlaps one already kept. Kept labels and their masks go into a uniform
+grid of pixel cells, so each label is only tested against the few kept ones
+near it instead of all of them.
+
+A label is described by a rectangle and a list of mask rectangles around it,
+as in geometry.py. Two labels overlap if a mask of either one intersects
+the other's label, like Place.overlaps() in arrange.py.
+"""
+from geometry import intersects, buffered
+from mercator import project
+
+class Grid:
+    """ Uniform grid of labels and masks, keyed on pixel cells.
+    """
+    def __init__(self, cellsize=256):
+        self._cellsize = float(cellsize)
+        self._cells = {}
+
+    def _cells_for(self, extent):
+        x1, y1, x2, y2 = extent
+        col1, row1 = int(x1 // self._cellsize), int(y1 // self._cellsize)
+        col2, row2 = int(x2 // self._cellsize), int(y2 // self._cellsize)
+
+        for col in range(col1, col2 + 1):
+            for row in range(row1, row2 + 1):
+                yield col, row
+
+    def add(self, index, label, masks):
+        """ Add a label with its masks under an index.
+        """
+        for cell in self._cells_for(extent(label, masks)):
+            self._cells.setdefault(cell, []).append((index, label, masks))
+
+    def blocker(self, label, masks):
+        """ Return the lowest index of an overlapping label in the grid, or None.
+        """
+        blockers = [index for cell in self._cells_for(extent(label, masks))
+                    for (index, other_label, other_masks) in self._cells.get(cell, ())
+                    if overlaps(label, masks, other_label, other_masks)]
+
+        if not blockers:
+            return None
+
+        return min(blockers)
+
+def extent(label, masks):
+    """ Return a rectangle around a label and its masks, ignoring empty masks.
+    """
+    rects = [rect for rect in [label] + list(masks) if rect[0] <= rect[2]]
+
+    return min([x1 for (x1, y1, x2, y2) in rects]), min([y1 for (x1, y1, x2, y2) in rects]), \
+           max([x2 for (x1, y1, x2, y2) in rects]), max([y2 for (x1, y1, x2, y2) in rects])
+
+def overlaps(label, masks, other_label, other_masks):
+    """ Return true if either of two labels has a mask that intersects the other label.
+    """
+    return any([intersects(mask, other_label) for mask in masks]) \
+        or any([intersects(mask, label) for mask in other_masks])
+
+def cull(labels, cellsize=256):
+    """ Return a list of which labels to skip, from a list of (label, masks) in order of importance.
+
+        Each item of the list is None for a label that is kept, or the index
+        of the first kept label that it overlaps.
+    """
+    grid, blockers = Grid(cellsize), []
+
+    for (index, (label, masks)) in enumerate(labels):
+        blocker = grid.blocker(label, masks)
+        blockers.append(blocker)
+
+        if blocker is None:
+            grid.add(index, label, masks)
+
+    return blockers
+
+def feature_order(feature):
+    """ Sort key for label features, like compare_places() in arrange.py.
+    """
+    properties = feature['properties']
+    return -int(properties.get('place') == 'country'), properties['rank'], -(properties.get('population') or 0)
+
+def feature_bboxes(features, zoom):
+    """ Return pixel rectangles at a zoom level for GeoJSON label features written by arrange.py.
+    """
+    corners = [feature['geometry']['coordinates'][0] for feature in features]
+    lons = [lon for ring in corners for (lon, lat) in ring]
+    lats = [lat for ring in corners for (lon, lat) in ring]
+    xs, ys = project(lats, lons, zoom)
+
+    bboxes, offset = [], 0
+
+    for ring in corners:
+        x, y = xs[offset:offset + len(ring)], ys[offset:offset + len(ring)]
+        bboxes.append((x.min(), y.min(), x.max(), y.max()))
+        offset += len(ring)
+
+    return bboxes
+
+def point_masks(features, points, zoom, radius=4):
+    """ Return a tuple of pixel rectangles for the point of each label feature, empty for none.
+
+        Points are the GeoJSON point features written with the labels, in
+        the same order. Like City in arrange.py, only cities below zoom 9
+        have their points masked.
+    """
+    if points is None or zoom >= 9:
+        return [() for feature in features]
+
+    lons = [point['geometry']['coordinates'][0] for point in points]
+    lats = [point['geometry']['coordinates'][1] for point in points]
+    xs, ys = project(lats, lons, zoom)
+
+    return [(feature['properties'].get('place') == 'city' and ((x - radius, y - radius, x + radius, y + radius), ) or ())
+            for (feature, x, y) in zip(features, xs, ys)]
+
+def cull_features(features, zoom, buffer=2, cellsize=256, points=None):
+    """ Return the GeoJSON label features that do not overlap more important ones, in their original order.
+
+        Features are label polygons written by arrange.py at a zoom level,
+        and are masked by their labels grown by buffer pixels. Given the
+        point features written with them, cities are masked by their
+        points too, so the result matches the culling in write_places().
+    """
+    labels = feature_bboxes(features, zoom)
+    points = point_masks(features, points, zoom)
+    order = sorted(range(len(features)), key=lambda index: feature_order(features[index]))
+    blockers = cull([(labels[index], (buffered(labels[index], buffer), ) + points[index]) for index in order], cellsize)
+    kept = set([index for (index, blocker) in zip(order, blockers) if blocker is None])
+
+    return [feature for (index, feature) in enumerate(features) if index in kept]
@@ -0,0 +1,97 @@
+""" Text extents for label sizing, cached on disk between runs.
+
+Measuring every place name with PIL is a large part of loading places, and
+the same names are measured in the same few fonts for every zoom level.
+Extents are kept in a marshal file as a dictionary of dictionaries:
+
+  {(font file md5, size): {text: (width, height)}}
+"""
+from os import rename, getpid
+from os.path import exists
+from marshal import load, dump
+from hashlib import md5
+
+from PIL.ImageFont import truetype
+
+class FontMetrics:
+    """ Cache of text extents for any number of fonts, stored in one file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._extents = read_extents(filename)
+        self._hashes = {}
+        self._dirty = False
+
+    def font(self, fontfile, fontsize):
+        """ Return a MeasuredFont for a font file and point size.
+        """
+        if fontfile not in self._hashes:
+            self._hashes[fontfile] = md5(open(fontfile, 'rb').read()).hexdigest()
+
+        extents = self._extents.setdefault((self._hashes[fontfile], fontsize), {})
+        return MeasuredFont(self, truetype(fontfile, fontsize, encoding='unic'), extents)
+
+    def save(self):
+        """ Write any new extents to the cache file, merged with what's there now.
+
+            Other runs may be saving to the same file, so it's reread
+            first and replaced in one rename.
+        """
+        if not self._dirty:
+            return
+
+        extents = read_extents(self.filename)
+
+        for (key, sizes) in self._extents.items():
+            extents.setdefault(key, {}).update(sizes)
+
+        temporary = '%s.%d' % (self.filename, getpid())
+        file = open(temporary, 'wb')
+        dump(extents, file)
+        file.close()
+        rename(temporary, self.filename)
+
+        self._dirty = False
+
+class MeasuredFont:
+    """ PIL font wrapper that looks up text extents in a FontMetrics cache.
+
+        Masks come straight from the wrapped font, so instances can still
+        be used to draw text.
+    """
+    def __init__(self, font_metrics, font, extents):
+        self.font_metrics = font_metrics
+        self._font = font
+        self._extents = extents
+
+    def getmask(self, *args, **kwargs):
+        return self._font.getmask(*args, **kwargs)
+
+    def getmask2(self, *args, **kwargs):
+        return self._font.getmask2(*args, **kwargs)
+
+    def getsize(self, text):
+        if text not in self._extents:
+            self.measure([text])
+
+        return self._extents[text]
+
+    def measure(self, texts):
+        """ Measure all of texts not already in the cache.
+        """
+        for text in set(texts):
+            if text not in self._extents:
+                self._extents[text] = self._font.getsize(text)
+                self.font_metrics._dirty = True
+
+def read_extents(filename):
+    """ Return the extents dictionary from a cache file, or an empty one.
+    """
+    if not exists(filename):
+        return {}
+
+    try:
+        return load(open(filename, 'rb'))
+    except (EOFError, ValueError, TypeError):
+        # a damaged cache is only a slower start
+        return {}
@@ -0,0 +1,108 @@
+""" Axis-aligned label rectangles, tested for overlap with plain arithmetic.
+
+Rectangles are (x1, y1, x2, y2) tuples in pixels, with x1 <= x2 and y1 <= y2.
+Like shapely's intersects(), rectangles that only touch at an edge overlap.
+"""
+from numpy import empty, inf, array, arange, uint16
+
+# a rectangle that overlaps nothing, for places with no point mask
+NOWHERE = (inf, inf, -inf, -inf)
+
+def intersects(this, that):
+    """ Return true if two rectangles overlap.
+    """
+    return this[0] <= that[2] and that[0] <= this[2] \
+       and this[1] <= that[3] and that[1] <= this[3]
+
+def buffered(rect, buffer):
+    """ Return a rectangle grown on all sides by buffer.
+    """
+    x1, y1, x2, y2 = rect
+    return x1 - buffer, y1 - buffer, x2 + buffer, y2 + buffer
+
+def near(rect):
+    """ Return a rectangle in the form used on the near side of an overlap test.
+    """
+    x1, y1, x2, y2 = rect
+    return x1, y1, -x2, -y2
+
+def far(rect):
+    """ Return a rectangle in the form used on the far side of an overlap test.
+    """
+    x1, y1, x2, y2 = rect
+    return -x2, -y2, x1, y1
+
+def blocks(label, buffer, point=NOWHERE):
+    """ Return the near and far blocks for a label, described in Rectangles below.
+    """
+    mask = buffered(label, buffer)
+    return array((near(mask), near(point), near(label), near(label))), \
+           array((far(label), far(label), far(mask), far(point)))
+
+def conflict_table(these, those):
+    """ Return a table of which label choices of two places overlap.
+    
+        Arguments are lists of (near, far) blocks for each alternative label
+        of the two places. Each row of the table is a bitmap of the choices
+        of the second place that conflict with one choice of the first.
+    """
+    nears = array([n for (n, f) in these])
+    fars = array([f for (n, f) in those])
+    overlaps = ((nears[:,None] + fars[None,:]) <= 0).all(3).any(2)
+    
+    return (overlaps * (1 << arange(len(those)))).sum(1).astype(uint16)
+
+class Rectangles:
+    """ Struct-of-arrays store of label, mask and point rectangles, one row per place.
+
+        The mask of a place is its label grown by its buffer, plus its point
+        rectangle if it has one. One place overlaps another if either mask
+        intersects the other label.
+
+        Rectangles a and b intersect when every element of near(a) + far(b)
+        is zero or less, so each place keeps two 4x4 blocks arranged to test
+        all four mask/label pairs of a neighbor in one sum:
+
+          near block: mask, point, label, label
+          far block:  label, label, mask, point
+    """
+    def __init__(self, count):
+        self._near = empty((count, 4, 4))
+        self._far = empty((count, 4, 4))
+
+    def __len__(self):
+        return len(self._near)
+
+    def set(self, index, label, buffer, point=NOWHERE):
+        self.set_label(index, label, buffer)
+        self._near[index, 1] = near(point)
+        self._far[index, 3] = far(point)
+
+    def set_label(self, index, label, buffer):
+        mask = buffered(label, buffer)
+        self._near[index, 0] = near(mask)
+        self._near[index, 2:] = near(label)
+        self._far[index, :2] = far(label)
+        self._far[index, 2] = far(mask)
+
+    def set_blocks(self, index, near, far):
+        self._near[index] = near
+        self._far[index] = far
+
+    def overlaps(self, index, others):
+        """ Return a boolean array of which places in others overlap the place at index.
+        """
+        sums = self._far[others] + self._near[index]
+        return (sums <= 0).all(2).any(1)
+
+    def near_overlaps(self, near, others):
+        """ Return a boolean array of which places in others overlap a near block from blocks().
+        """
+        sums = self._far[others] + near
+        return (sums <= 0).all(2).any(1)
+
+    def pair_overlaps(self, indexes, others):
+        """ Return a boolean array of which places in indexes overlap the places in others, pair by pair.
+        """
+        sums = self._far[others] + self._near[indexes]
+        return (sums <= 0).all(2).any(1)
@@ -1,10 +1,86 @@
 """ Join multiple GeoJSON files into one on stdout.
+
+Features are read from each file and written out one at a time, so only
+a single feature needs to be in memory at once.
 """
-from sys import argv, stdout
-from json import load, dump
-from operator import add
+from sys import stdout
+from json import JSONDecoder, dumps
+from optparse import OptionParser
+
+optparser = OptionParser(usage="""%prog [options] <GeoJSON files>""")
+
+optparser.add_option('-d', '--dedupe', dest='dedupe', action='store_true',
+                     help='Write only the first feature with any geonameid, for places in more than one input file.')
+
+def features(file, chunksize=65536):
+    """ Generate the features of a GeoJSON FeatureCollection file, decoded one at a time.
+    """
+    decoder, buffer, eof = JSONDecoder(), '', False
+
+    def more(buffer):
+        chunk = file.read(chunksize)
+        return buffer + chunk, not chunk
+
+    # skip ahead to the start of the features list
+    while '"features"' not in buffer:
+        if eof:
+            return
+        buffer, eof = more(buffer[-len('"features"'):])
+
+    buffer = buffer[buffer.index('"features"') + len('"features"'):]
+
+    while not buffer.lstrip(' \t\r\n:'):
+        if eof:
+            return
+        buffer, eof = more(buffer)
+
+    buffer = buffer.lstrip(' \t\r\n:')[1:]
+
+    # decoding moves an index along the buffer, which is only cut
+    # down to what's left of it when the next chunk is read
+    index = 0
+
+    while True:
+        while index < len(buffer) and buffer[index] in ' \t\r\n,':
+            index += 1
+
+        if index == len(buffer) and not eof:
+            buffer, eof = more(buffer[index:])
+            index = 0
+            continue
+
+        if index == len(buffer) or buffer[index] == ']':
+            return
+
+        try:
+            feature, index = decoder.raw_decode(buffer, index)
+        except ValueError:
+            if eof:
+                raise
+            # the feature is cut off at the end of the buffer
+            buffer, eof = more(buffer[index:])
+            index = 0
+            continue
+
+        yield feature
 
 if __name__ == '__main__':
-    collections = [load(open(filename, 'r')) for filename in argv[1:]]
-    features = reduce(add, [c['features'] for c in collections], [])
-    dump({'type': 'FeatureCollection', 'features': features}, stdout)
+    opts, filenames = optparser.parse_args()
+    seen = set()
+
+    stdout.write('{"type": "FeatureCollection", "features": [')
+    separator = ''
+
+    for filename in filenames:
+        for feature in features(open(filename, 'r')):
+            geonameid = feature.get('properties', {}).get('geonameid')
+
+            if opts.dedupe and geonameid is not None:
+                if geonameid in seen:
+                    continue
+                seen.add(geonameid)
+
+            stdout.write(separator + dumps(feature))
+            separator = ', '
+
+    stdout.write(']}\n')
@@ -0,0 +1,44 @@
+""" Spherical mercator projection of whole arrays of locations at once.
+
+Results are the same as ModestMaps' OpenStreetMap provider to the last bit:
+the transformation is taken from the provider, and each step is done in
+the same order with the same functions, just on numpy arrays.
+"""
+from math import pi, e
+
+from numpy import asarray, log, tan, arctan, power
+
+from ModestMaps.OpenStreetMap import Provider
+
+_transform = Provider().projection.transformation
+
+def project(lats, lons, zoom):
+    """ Return arrays of x and y pixels for degree latitudes and longitudes.
+
+        Pixels are for 2^8 tile size at the given zoom level.
+    """
+    t, scale = _transform, 2.0 ** (zoom + 8)
+
+    x = pi * asarray(lons, dtype=float) / 180.0
+    y = log(tan(0.25 * pi + 0.5 * (pi * asarray(lats, dtype=float) / 180.0)))
+
+    column = t.ax * x + t.bx * y + t.cx
+    row = t.ay * x + t.by * y + t.cy
+
+    return column * scale, row * scale
+
+def unproject(xs, ys, zoom):
+    """ Return arrays of degree latitudes and longitudes for x and y pixels.
+
+        Pixels are for 2^8 tile size at the given zoom level.
+    """
+    t, scale = _transform, 2.0 ** -(zoom + 8)
+
+    column = asarray(xs, dtype=float) * scale
+    row = asarray(ys, dtype=float) * scale
+
+    x = (column*t.by - row*t.bx - t.cx*t.by + t.cy*t.bx) / (t.ax*t.by - t.ay*t.bx)
+    y = (column*t.ay - row*t.ax - t.cx*t.ay + t.cy*t.ax) / (t.bx*t.ay - t.by*t.ax)
+    y = 2 * arctan(power(e, y)) - 0.5 * pi
+
+    return 180.0 * y / pi, 180.0 * x / pi
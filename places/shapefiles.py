@@ -0,0 +1,284 @@
+""" Shapefiles of points and polygons, written directly for Mapnik.
+
+Writes the .shp, .shx and .dbf files of a shapefile along with a .prj for
+WGS84 and a .cpg naming the UTF-8 encoding of the text fields, so that no
+GeoJSON has to be parsed again by ogr2ogr.
+
+Also writes the .index file that Mapnik's shapeindex utility would make,
+a quadtree of byte offsets into the .shp file. Mapnik uses it to read only
+the shapes near a tile instead of scanning the whole file.
+
+Shapefiles written here can be read back as GeoJSON-style features, so a
+labels shapefile can seed another zoom or be indexed by tile-lookup.py.
+"""
+from os.path import splitext
+from struct import pack, unpack_from
+from datetime import date
+
+POINT, POLYGON = 1, 5
+
+# the same projection file that ogr2ogr writes for EPSG:4326
+WGS84 = 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],' \
+        'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]'
+
+# quadtree shape and depth, as in Mapnik's shapeindex
+INDEX_RATIO, INDEX_DEPTH = .55, 8
+
+def write_points(filename, points, records, fields):
+    """ Write a shapefile of (x, y) points with a record for each.
+
+        Records are dictionaries, and fields is a list of (name, kind)
+        with kind 'C' for text or 'N' for whole numbers.
+    """
+    shapes = [((x, y, x, y), pack('<idd', POINT, x, y)) for (x, y) in points]
+    return write_shapes(filename, POINT, shapes, records, fields)
+
+def write_polygons(filename, rings, records, fields):
+    """ Write a shapefile of single-ring polygons with a record for each.
+
+        Rings are lists of (x, y) that start and end at the same point,
+        in clockwise order as the shapefile spec requires for outer rings.
+    """
+    shapes = []
+
+    for ring in rings:
+        xs, ys = [x for (x, y) in ring], [y for (x, y) in ring]
+        bbox = min(xs), min(ys), max(xs), max(ys)
+        coords = [coord for point in ring for coord in point]
+
+        content = pack('<i4d2i', POLYGON, bbox[0], bbox[1], bbox[2], bbox[3], 1, len(ring)) \
+                + pack('<i', 0) + pack('<%dd' % len(coords), *coords)
+
+        shapes.append((bbox, content))
+
+    return write_shapes(filename, POLYGON, shapes, records, fields)
+
+def write_shapes(filename, shapetype, shapes, records, fields):
+    """ Write a shapefile and its companion files from a list of (bbox, content).
+
+        Returns the (offset, length) in bytes of each shape's record in the .shp file.
+    """
+    base = splitext(filename)[0]
+
+    if shapes:
+        bbox = min([b[0] for (b, c) in shapes]), min([b[1] for (b, c) in shapes]), \
+               max([b[2] for (b, c) in shapes]), max([b[3] for (b, c) in shapes])
+    else:
+        bbox = 0, 0, 0, 0
+
+    shp, shx, offsets = open(base + '.shp', 'wb'), open(base + '.shx', 'wb'), []
+
+    shp_length = 100 + sum([8 + len(content) for (b, content) in shapes])
+    shp.write(header(shp_length, shapetype, bbox))
+    shx.write(header(100 + 8 * len(shapes), shapetype, bbox))
+
+    offset = 100
+
+    for (number, (b, content)) in enumerate(shapes):
+        shp.write(pack('>2i', number + 1, len(content) / 2))
+        shp.write(content)
+        shx.write(pack('>2i', offset / 2, len(content) / 2))
+        offsets.append(offset)
+        offset += 8 + len(content)
+
+    shp.close()
+    shx.close()
+
+    write_dbf(base + '.dbf', records, fields)
+    write_index(base + '.index', [b for (b, c) in shapes], offsets, bbox)
+
+    open(base + '.prj', 'w').write(WGS84)
+    open(base + '.cpg', 'w').write('UTF-8')
+
+    return [(offset, 8 + len(content)) for (offset, (b, content)) in zip(offsets, shapes)]
+
+def header(length, shapetype, bbox):
+    """ Return the 100-byte header of a .shp or .shx file, with length in bytes.
+    """
+    return pack('>7i', 9994, 0, 0, 0, 0, 0, length / 2) \
+         + pack('<2i4d4d', 1000, shapetype, bbox[0], bbox[1], bbox[2], bbox[3], 0, 0, 0, 0)
+
+def dbf_value(value, kind):
+    """ Return a value of a record as unpadded bytes for a .dbf field of a kind, 'C' or 'N'.
+    """
+    if value is None:
+        return ''
+
+    if kind == 'N':
+        return str(int(value))
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+def write_dbf(filename, records, fields):
+    """ Write a dBASE III table of records with the given fields.
+
+        Field widths are sized to fit the longest value, up to 254 bytes.
+    """
+    values = [[dbf_value(record.get(name), kind) for (name, kind) in fields] for record in records]
+    widths = [min(254, max([1] + [len(row[i]) for row in values])) for i in range(len(fields))]
+
+    today = date.today()
+
+    dbf = open(filename, 'wb')
+    dbf.write(pack('<4BI2H20x', 3, today.year - 1900, today.month, today.day, len(records),
+                   33 + 32 * len(fields), 1 + sum(widths)))
+
+    for ((name, kind), width) in zip(fields, widths):
+        dbf.write(pack('<11sc4xBB14x', name[:10], kind, width, 0))
+
+    dbf.write('\r')
+
+    for row in values:
+        dbf.write(' ')
+
+        for ((name, kind), width, value) in zip(fields, widths, row):
+            if kind == 'N':
+                dbf.write(value[:width].rjust(width))
+            else:
+                dbf.write(value[:width].ljust(width))
+
+    dbf.write('\x1a')
+    dbf.close()
+
+def read_features(filename):
+    """ Return a list of GeoJSON-style features from a shapefile of points or polygons.
+
+        Text fields come back as unicode and number fields as ints, with
+        empty values as None, like the properties that were written.
+    """
+    base = splitext(filename)[0]
+    shp = open(base + '.shp', 'rb').read()
+    features = []
+
+    for (offset, properties) in zip(shape_offsets(shp), read_dbf(base + '.dbf')):
+        shapetype = unpack_from('<i', shp, offset)[0]
+
+        if shapetype == POINT:
+            geometry = {'type': 'Point', 'coordinates': unpack_from('<2d', shp, offset + 4)}
+
+        elif shapetype == POLYGON:
+            count, length = unpack_from('<2i', shp, offset + 36)
+            parts = unpack_from('<%di' % count, shp, offset + 44) + (length, )
+            coords = unpack_from('<%dd' % (2 * length), shp, offset + 44 + 4 * count)
+            points = zip(coords[0::2], coords[1::2])
+
+            geometry = {'type': 'Polygon',
+                        'coordinates': [points[start:end] for (start, end) in zip(parts[:-1], parts[1:])]}
+
+        else:
+            raise ValueError('Unsupported shape type %d in %s' % (shapetype, filename))
+
+        features.append({'type': 'Feature', 'geometry': geometry, 'properties': properties})
+
+    return features
+
+def shape_offsets(shp):
+    """ Return the offsets in the contents of a .shp file of each shape, after its record header.
+    """
+    length = unpack_from('>i', shp, 24)[0] * 2
+    offsets, offset = [], 100
+
+    while offset < length:
+        offsets.append(offset + 8)
+        offset += 8 + unpack_from('>i', shp, offset + 4)[0] * 2
+
+    return offsets
+
+def read_dbf(filename):
+    """ Return a list of records from a dBASE III table written by write_dbf().
+    """
+    dbf = open(filename, 'rb').read()
+    count, first, length = unpack_from('<I2H', dbf, 4)
+    fields, offset = [], 32
+
+    while dbf[offset] != '\r':
+        name, kind, width = unpack_from('<11sc4xB', dbf, offset)
+        fields.append((name.rstrip('\0'), kind, width))
+        offset += 32
+
+    records = []
+
+    for offset in range(first, first + count * length, length):
+        # each record starts with a byte for whether it was deleted
+        record, offset = {}, offset + 1
+
+        for (name, kind, width) in fields:
+            value = dbf[offset:offset + width].strip()
+            offset += width
+
+            if not value:
+                record[name] = None
+            elif kind == 'N':
+                record[name] = int(value)
+            else:
+                record[name] = value.decode('utf-8')
+
+        records.append(record)
+
+    return records
+
+class Node:
+    """ One box of the quadtree in a Mapnik .index file.
+    """
+    def __init__(self, bbox):
+        self.bbox = bbox
+        self.offsets = []
+        self.children = [None] * 4
+
+    def insert(self, bbox, offset, depth):
+        """ Add a shape to the smallest node under this one that contains its bbox.
+        """
+        if depth < INDEX_DEPTH:
+            for (i, child_bbox) in enumerate(split(self.bbox)):
+                if contains(child_bbox, bbox):
+                    if self.children[i] is None:
+                        self.children[i] = Node(child_bbox)
+
+                    return self.children[i].insert(bbox, offset, depth + 1)
+
+        self.offsets.append(offset)
+
+    def size(self):
+        """ Return the size in bytes of this node and all the nodes under it.
+        """
+        return 44 + 4 * len(self.offsets) + sum([child.size() for child in self.children if child])
+
+    def write(self, file):
+        """ Write this node and then its children, depth-first.
+        """
+        children = [child for child in self.children if child]
+        file.write(pack('<i4di', sum([child.size() for child in children]),
+                        self.bbox[0], self.bbox[1], self.bbox[2], self.bbox[3], len(self.offsets)))
+        file.write(pack('<%di' % len(self.offsets), *self.offsets))
+        file.write(pack('<i', len(children)))
+
+        for child in children:
+            child.write(file)
+
+def split(bbox):
+    """ Return the four overlapping quarters of a bbox, like Mapnik's quadtree.
+    """
+    x1, y1, x2, y2 = bbox
+    width, height = (x2 - x1) * INDEX_RATIO, (y2 - y1) * INDEX_RATIO
+
+    return [(x1, y1, x1 + width, y1 + height), (x2 - width, y1, x2, y1 + height),
+            (x1, y2 - height, x1 + width, y2), (x2 - width, y2 - height, x2, y2)]
+
+def contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+def write_index(filename, bboxes, offsets, bbox):
+    """ Write a Mapnik .index quadtree of .shp byte offsets for shapes with the given bboxes.
+    """
+    root = Node(bbox)
+
+    for (shape_bbox, offset) in zip(bboxes, offsets):
+        root.insert(shape_bbox, offset, 0)
+
+    file = open(filename, 'wb')
+    file.write('mapnik-index'.ljust(16, '\0'))
+    root.write(file)
+    file.close()
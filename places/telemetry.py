@@ -0,0 +1,60 @@
+""" Timings and counts from arrange.py runs, written as JSON lines.
+
+Each line is one JSON object with an "event" name, the time, the process ID
+and whatever values go with the event, so runs can be compared to find where
+the time goes and when it changes. Nothing is written until setup() is given
+a filename, and worker processes forked after that write to the same file.
+
+Also keeps whether to print a line for every place loaded and skipped.
+"""
+from os import getpid
+from time import time
+from json import dumps
+
+_file, _verbose, _context = None, False, {}
+
+def setup(filename=None, verbose=False):
+    """ Start appending metrics to a file, if named, and say whether to print every place.
+    """
+    global _file, _verbose
+
+    _file = filename and open(filename, 'a') or None
+    _verbose = verbose
+
+def set_context(**values):
+    """ Add values to every line recorded after this, like the zoom of a job.
+    """
+    _context.update(values)
+
+def verbose():
+    """ Return true if a line should be printed for every place.
+    """
+    return _verbose
+
+def record(event, values={}):
+    """ Record an event with a dictionary of values, as one line of JSON.
+
+        Made to be passed as the metrics function of an Annealer.
+    """
+    if _file is None:
+        return
+
+    line = dict(_context, event=event, time=round(time(), 3), pid=getpid())
+    line.update(values)
+
+    # one write per line, flushed so lines from forked workers never mix
+    _file.write(dumps(line, sort_keys=True) + '\n')
+    _file.flush()
+
+class Phases:
+    """ Wall times of a run of steps, each recorded as a "phase" event when done.
+    """
+    def __init__(self):
+        self._start = time()
+
+    def done(self, phase, **values):
+        """ Record the time since the last phase finished, or since this began.
+        """
+        now = time()
+        record('phase', dict(values, phase=phase, seconds=round(now - self._start, 4)))
+        self._start = now
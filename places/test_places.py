@@ -0,0 +1,330 @@
+""" Checks of the incremental energy, overlap tables and file formats used by arrange.py.
+
+Run from this directory with "python -m unittest test_places".
+
+Places here are laid out with a fake font of fixed-width characters, so
+the checks need no font files, and close enough together that many of
+their labels overlap.
+"""
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+from random import seed, random, randint, choice
+from struct import unpack
+import unittest
+
+from numpy import array
+
+from arrange import Places, City, Country, placements, location_points
+from geometry import Rectangles, NOWHERE, blocks, conflict_table
+from columns import open_columns, NO_POPULATION
+from tiles import hilbert, label_tiles, build_tile_lookup, TileLookup
+from shapefiles import write_points, write_polygons, read_features
+
+class FakeFont:
+    """ Font with every character 7 pixels wide and 12 high.
+    """
+    def getsize(self, text):
+        return 7 * len(text), 12
+
+def make_places(count=60, zoom=5, focus=0.0):
+    """ Return Places with a few countries and many cities crowded around them.
+    """
+    seed(count)
+    places, font = Places(focus=focus), FakeFont()
+
+    lats = array([40 + random() * 8 for i in range(count)])
+    lons = array([-10 + random() * 14 for i in range(count)])
+    locations, points = location_points(lats, lons, zoom)
+
+    for (index, (location, point)) in enumerate(zip(locations, points)):
+        if index < 3:
+            places.add(Country('Country %d' % index, 'C%d' % index, 1, zoom - 2, 1000, 10 ** 7,
+                               location, point, font))
+        else:
+            places.add(City(u'City %d' % index, randint(1, 3), zoom, randint(0, 10 ** 6),
+                            str(index), location, point, font))
+
+    places.refresh()
+    return places
+
+def full_energy(places):
+    """ Return the energy of places added up from scratch.
+    """
+    return sum([place.placement_energy() for place in places]) \
+         + sum([place.overlap_energy(other) for place in places
+                for other in places.neighbors(place) if id(place) < id(other)])
+
+def conflicted(places):
+    """ Return the moveable places that overlap any neighbor.
+    """
+    return [place for place in places.moveable()
+            if [other for other in places.neighbors(place) if place.overlaps(other)]]
+
+def chance(places, place):
+    """ Return the chance of choosing place for a move, found from scratch.
+    """
+    uniform, found = 1.0 / len(places.moveable()), conflicted(places)
+
+    if not found:
+        return uniform
+
+    # places compare equal by rank and population, so look for this one by identity
+    focused = [other for other in found if other is place] and 1.0 / len(found) or 0.0
+    return places.focus * focused + (1 - places.focus) * uniform
+
+class EnergyTests (unittest.TestCase):
+
+    def test_propose_commit(self):
+        places = make_places()
+
+        for step in range(300):
+            proposal = places.propose()
+            energy = places.energy()
+
+            if random() < .5:
+                places.commit(proposal)
+                self.assertAlmostEqual(places.energy(), energy + proposal[2])
+
+            self.assertAlmostEqual(places.energy(), full_energy(places))
+
+    def test_move_undo(self):
+        places = make_places()
+
+        for step in range(300):
+            energy = places.energy()
+            token = places.move()
+            self.assertAlmostEqual(places.energy(), full_energy(places))
+
+            if random() < .5:
+                places.undo(token)
+                self.assertAlmostEqual(places.energy(), energy)
+                self.assertAlmostEqual(places.energy(), full_energy(places))
+
+    def test_sweep(self):
+        places = make_places()
+
+        for temperature in (10.0, 1.0, .1):
+            places.sweep(temperature)
+            self.assertAlmostEqual(places.energy(), full_energy(places))
+
+    def test_snapshot_restore(self):
+        places = make_places()
+        snapshot, energy = places.snapshot(), places.energy()
+
+        for step in range(50):
+            places.commit(places.propose())
+
+        places.restore(snapshot)
+        self.assertAlmostEqual(places.energy(), energy)
+        self.assertAlmostEqual(places.energy(), full_energy(places))
+
+class OverlapTests (unittest.TestCase):
+
+    def test_rectangles(self):
+        places = make_places()
+        places.settled()
+
+        for step in range(100):
+            for place in places:
+                index = places._index[place]
+                neighbors, overlaps = places._overlaps(index)
+                expected = [place.overlaps(places._places[other]) for other in neighbors]
+                self.assertEqual(overlaps.astype(bool).tolist(), expected)
+
+            places.commit(places.propose())
+
+    def test_near_and_far_blocks(self):
+        places = [place for place in make_places()]
+        rects = Rectangles(len(places))
+
+        for (index, place) in enumerate(places):
+            rects.set(index, place.label_bbox(), place.buffer, getattr(place, '_point_shape', NOWHERE))
+
+        for (index, place) in enumerate(places):
+            others = array([other for other in range(len(places)) if other != index])
+            expected = [place.overlaps(places[other]) for other in others]
+            self.assertEqual(rects.overlaps(index, others).tolist(), expected)
+
+    def test_conflict_tables(self):
+        places = make_places()
+        cities = [place for place in places if place.__class__ is City]
+
+        for city in cities[:10]:
+            for other in places.neighbors(city):
+                if other.__class__ is not City:
+                    continue
+
+                these = [blocks(label, city.buffer, city._point_shape) for label in city.label_bboxes()]
+                those = [blocks(label, other.buffer, other._point_shape) for label in other.label_bboxes()]
+                table = conflict_table(these, those)
+
+                for placement in sorted(placements):
+                    for other_placement in sorted(placements):
+                        city.restore(placement)
+                        other.restore(other_placement)
+                        self.assertEqual(bool(table[placement] >> other_placement & 1), city.overlaps(other))
+
+class ChanceTests (unittest.TestCase):
+
+    def test_proposal_bias(self):
+        places = make_places(focus=.5)
+
+        for step in range(200):
+            proposal = places.propose()
+            place, ratio = proposal[0], places.proposal_bias(proposal)
+            before = chance(places, place)
+
+            places.commit(proposal)
+            self.assertAlmostEqual(ratio, chance(places, place) / before)
+
+    def test_move_bias(self):
+        places = make_places(focus=.5)
+
+        for step in range(200):
+            token = places.move()
+            place = token[0]
+
+            # chance of choosing the place before the move, found by undoing it
+            redo = places.undo(token)
+            before = chance(places, place)
+            places.undo(redo)
+
+            self.assertAlmostEqual(places.bias(token), chance(places, place) / before)
+
+class ColumnsTests (unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp(prefix='test-places-')
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def test_round_trip(self):
+        rows = [(5, '1', u'Z\xfcrich', 47.37, 8.55, '341730'),
+                (4, '2', u'Amsterdam', 52.37, 4.89, '741636'),
+                (5, '3', u'', 1.5, -2.5, ''),
+                (4, '4', u'Ath\xe8nes', 37.98, 23.72, '729137')]
+
+        filename = join(self.dirname, 'cities.txt')
+        file = open(filename, 'w')
+        file.write('zoom\tgeonameid\tname\tlatitude\tlongitude\tpopulation\n')
+
+        for row in rows:
+            file.write('%d\t%s\t%s\t%r\t%r\t%s\n' % (row[0], row[1], row[2].encode('utf-8'), row[3], row[4], row[5]))
+
+        file.close()
+
+        # zooms sort first, keeping the order of rows within each zoom
+        ordered = [rows[1], rows[3], rows[0], rows[2]]
+        cachedir = join(self.dirname, 'cache')
+
+        for attempt in range(2):
+            columns = open_columns(filename, cachedir)
+
+            self.assertEqual(len(columns), 4)
+            self.assertEqual(columns.count(4), 2)
+            self.assertEqual(columns.count(5), 4)
+            self.assertEqual(columns.numbers('zoom').tolist(), [row[0] for row in ordered])
+            self.assertEqual(columns.strings('geonameid', 4), [row[1] for row in ordered])
+            self.assertEqual(columns.texts('name', 4), [row[2] for row in ordered])
+            self.assertEqual(columns.texts('name', 2), [row[2] for row in ordered[:2]])
+            self.assertEqual(columns.numbers('latitude').tolist(), [row[3] for row in ordered])
+            self.assertEqual(columns.numbers('longitude').tolist(), [row[4] for row in ordered])
+            self.assertEqual(columns.numbers('population').tolist(),
+                             [row[5] and int(row[5]) or NO_POPULATION for row in ordered])
+
+class TilesTests (unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp(prefix='test-places-')
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def test_hilbert(self):
+        order = 4
+        cells = dict([(hilbert(x, y, order), (x, y)) for x in range(2 ** order) for y in range(2 ** order)])
+        self.assertEqual(sorted(cells.keys()), range(4 ** order))
+
+        # each step along the curve goes to a neighboring cell
+        for distance in range(1, 4 ** order):
+            (x1, y1), (x2, y2) = cells[distance - 1], cells[distance]
+            self.assertEqual(abs(x1 - x2) + abs(y1 - y2), 1)
+
+    def test_tile_lookup(self):
+        seed(1)
+        zoom = 6
+        bboxes = []
+
+        for number in range(500):
+            x, y = random() * 2 ** (zoom + 8), random() * 2 ** (zoom + 8)
+            bboxes.append((x, y, x + randint(1, 300), y + randint(1, 40)))
+
+        tiles = label_tiles(bboxes, zoom, 16)
+        expected = {}
+
+        for (key, number) in tiles:
+            expected.setdefault(key, []).append(number)
+
+        dirname = join(self.dirname, 'lookup')
+        build_tile_lookup(dirname, tiles)
+        lookup = TileLookup(dirname)
+
+        for col in range(2 ** zoom):
+            for row in range(2 ** zoom):
+                key = (zoom << 58) | (col << 29) | row
+                self.assertEqual(lookup.labels(zoom, col, row).tolist(), expected.get(key, []))
+
+        self.assertEqual(lookup.labels(zoom + 1, 0, 0).tolist(), [])
+
+class ShapefilesTests (unittest.TestCase):
+
+    fields = [('name', 'C'), ('rank', 'N'), ('population', 'N'), ('geonameid', 'C')]
+
+    def setUp(self):
+        self.dirname = mkdtemp(prefix='test-places-')
+        self.records = [{'name': u'S\xe3o Paulo', 'rank': 1, 'population': 10021295, 'geonameid': u'3448439'},
+                        {'name': u'Nowhere', 'rank': 3, 'population': None, 'geonameid': None}]
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def check_spans(self, filename, spans):
+        """ Check that byte spans of shapes agree with the .shx file and the end of the .shp file.
+        """
+        shx = open(filename[:-4] + '.shx', 'rb').read()[100:]
+        shp = open(filename, 'rb').read()
+
+        offsets = [2 * offset for offset in unpack('>%di' % (len(shx) / 4), shx)[0::2]]
+        self.assertEqual([offset for (offset, length) in spans], offsets)
+        self.assertEqual(spans[-1][0] + spans[-1][1], len(shp))
+        self.assertEqual(2 * unpack('>i', shp[24:28])[0], len(shp))
+
+        self.assertTrue(exists(filename[:-4] + '.index'))
+        self.assertEqual(open(filename[:-4] + '.index', 'rb').read(12), 'mapnik-index')
+
+    def test_points(self):
+        filename = join(self.dirname, 'points.shp')
+        points = [(-46.63, -23.55), (0.5, 0.25)]
+        spans = write_points(filename, points, self.records, self.fields)
+
+        self.check_spans(filename, spans)
+
+        features = read_features(filename)
+        self.assertEqual([tuple(feature['geometry']['coordinates']) for feature in features], points)
+        self.assertEqual([feature['properties'] for feature in features], self.records)
+
+    def test_polygons(self):
+        filename = join(self.dirname, 'labels.shp')
+        rings = [[(0, 0), (0, 1), (2, 1), (2, 0), (0, 0)], [(-5.5, 3), (-5.5, 4.25), (1, 4.25), (1, 3), (-5.5, 3)]]
+        spans = write_polygons(filename, rings, self.records, self.fields)
+
+        self.check_spans(filename, spans)
+
+        features = read_features(filename)
+        self.assertEqual([feature['geometry']['coordinates'] for feature in features], [[ring] for ring in rings])
+        self.assertEqual([feature['properties'] for feature in features], self.records)
+
+if __name__ == '__main__':
+    unittest.main()
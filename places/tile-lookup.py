@@ -0,0 +1,65 @@
+""" Build a lookup of the labels in each map tile from a GeoJSON file or shapefile of labels.
+
+Labels are numbered by their order in the file, starting from zero, and each
+tile of each zoom lists the labels that touch it or come within a metatile
+buffer of it. The lookup is a directory that tiles.TileLookup memory-maps.
+
+Labels keep the size in pixels they were arranged at, so at deeper zooms
+they cover less of the map, the way a renderer draws them.
+"""
+from json import load
+from optparse import OptionParser
+
+from cull import feature_bboxes
+from shapefiles import read_features
+from tiles import label_tiles, build_tile_lookup
+
+optparser = OptionParser(usage="""%prog [options] <GeoJSON or .shp labels file> <output directory>""")
+
+optparser.set_defaults(zoom=5, zooms=None, buffer=64)
+
+optparser.add_option('-z', '--zoom', dest='zoom',
+                     type='int', help='Map zoom level the labels were arranged at. Default value is %default.')
+
+optparser.add_option('--zooms', dest='zooms',
+                     type='string', help='Range of zooms to look up tiles for, like "11-16". Default value is the zoom the labels were arranged at.')
+
+optparser.add_option('-b', '--buffer', dest='buffer',
+                     type='int', help='Pixels around each tile to count labels in, as for a metatile buffer. Default value is %default.')
+
+def scaled_bboxes(bboxes, levels):
+    """ Return pixel bboxes moved some number of zoom levels deeper, keeping their sizes.
+    """
+    scale = 2.0 ** levels
+
+    return [((x1 + x2) * scale / 2 - (x2 - x1) / 2, (y1 + y2) * scale / 2 - (y2 - y1) / 2,
+             (x1 + x2) * scale / 2 + (x2 - x1) / 2, (y1 + y2) * scale / 2 + (y2 - y1) / 2)
+            for (x1, y1, x2, y2) in bboxes]
+
+if __name__ == '__main__':
+    opts, args = optparser.parse_args()
+
+    if len(args) != 2:
+        optparser.error('Expected a labels file and an output directory.')
+
+    labelsfile, dirname = args
+
+    zooms = opts.zooms or str(opts.zoom)
+
+    try:
+        low, high = [int(zoom) for zoom in (zooms + '-' + zooms).split('-')[:2]]
+    except ValueError:
+        optparser.error('Bad zoom range: "%(zooms)s".' % locals())
+
+    if labelsfile.endswith('.shp'):
+        features = read_features(labelsfile)
+    else:
+        features = load(open(labelsfile))['features']
+    bboxes, tiles = feature_bboxes(features, opts.zoom), []
+
+    for zoom in range(low, high + 1):
+        tiles += label_tiles(scaled_bboxes(bboxes, zoom - opts.zoom), zoom, opts.buffer)
+
+    build_tile_lookup(dirname, tiles)
+
+    print 'Wrote %d tiles of %d labels to %s.' % (len(set([key for (key, number) in tiles])), len(features), dirname)
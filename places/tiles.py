@@ -0,0 +1,177 @@
+""" Map tiles of labels, for output that renderers can read a tile at a time.
+
+Features are put in order along a Hilbert curve through the pixels of a zoom
+level, so labels near each other on the map are near each other in the file.
+A tile index then maps each z/x/y tile to the few byte ranges of the file
+holding the features that touch it, which a renderer can read on their own.
+
+A tile lookup instead maps each tile to the numbers of the labels touching
+it, as a directory of .npy files that is memory-mapped and read in place.
+Tiles are found in a hash table with open addressing, so a query only ever
+reads a slot or two no matter how many tiles there are.
+"""
+from os import makedirs, rename, getpid
+from os.path import join, exists
+from json import dump as dumpjson
+from shutil import rmtree
+
+from numpy import array, load, save, argsort, bincount, cumsum, concatenate, uint32, uint64
+
+TILESIZE = 256
+
+# features closer together in a file than this many bytes share one range,
+# enough to span the comma and newline between two GeoJSON features
+GAP = 2
+
+def hilbert(x, y, order):
+    """ Return the distance to cell x, y along a Hilbert curve filling 2^order by 2^order cells.
+    """
+    distance, size = 0, 1 << order
+    s = size >> 1
+
+    while s:
+        rx, ry = int(x & s > 0), int(y & s > 0)
+        distance += s * s * ((3 * rx) ^ ry)
+
+        # rotate the quadrant so the curve inside it runs the right way
+        if not ry:
+            if rx:
+                x, y = size - 1 - x, size - 1 - y
+            x, y = y, x
+
+        s >>= 1
+
+    return distance
+
+def hilbert_order(bboxes, zoom):
+    """ Return indexes of pixel bboxes at a zoom, in order along a Hilbert curve through their centers.
+    """
+    order = zoom + 8
+    last = (1 << order) - 1
+
+    def distance(index):
+        x1, y1, x2, y2 = bboxes[index]
+        x, y = int((x1 + x2) / 2), int((y1 + y2) / 2)
+        return hilbert(min(max(x, 0), last), min(max(y, 0), last), order)
+
+    return sorted(range(len(bboxes)), key=distance)
+
+def bbox_tiles(bbox, zoom, buffer=0):
+    """ Return a list of (column, row) for the tiles at a zoom touched by a pixel bbox grown by buffer pixels.
+    """
+    x1, y1, x2, y2 = bbox
+    last = 2 ** zoom - 1
+
+    col1, row1 = int((x1 - buffer) // TILESIZE), int((y1 - buffer) // TILESIZE)
+    col2, row2 = int((x2 + buffer) // TILESIZE), int((y2 + buffer) // TILESIZE)
+
+    return [(col, row) for col in range(max(col1, 0), min(col2, last) + 1)
+                       for row in range(max(row1, 0), min(row2, last) + 1)]
+
+def tile_ranges(bboxes, spans, zoom):
+    """ Return a dictionary of "z/x/y" tiles to lists of [offset, length] byte ranges.
+
+        Bboxes are in pixels at the zoom, and spans are (offset, length)
+        of each feature in a file, in the order they were written.
+    """
+    tiles = {}
+
+    for (bbox, (offset, length)) in zip(bboxes, spans):
+        for (col, row) in bbox_tiles(bbox, zoom):
+            ranges = tiles.setdefault('%d/%d/%d' % (zoom, col, row), [])
+
+            if ranges and offset - (ranges[-1][0] + ranges[-1][1]) <= GAP:
+                ranges[-1][1] = offset + length - ranges[-1][0]
+            else:
+                ranges.append([offset, length])
+
+    return tiles
+
+def write_tile_index(filename, bboxes, spans, zoom):
+    """ Write a JSON index of the byte ranges of features in each tile at a zoom.
+    """
+    index = {'zoom': zoom, 'tiles': tile_ranges(bboxes, spans, zoom)}
+    dumpjson(index, open(filename, 'w'), sort_keys=True)
+
+# multiplier for Fibonacci hashing of tile keys, and the key of an empty slot
+HASH, EMPTY = 0x9E3779B97F4A7C15, 2 ** 64 - 1
+
+def tile_key(zoom, col, row):
+    """ Return one 64-bit number for a tile, with 29 bits each for column and row.
+    """
+    return (zoom << 58) | (col << 29) | row
+
+def slot(key, bits):
+    """ Return the first slot to look in for a key, in a table of 2^bits slots.
+    """
+    return ((key * HASH) & EMPTY) >> (64 - bits)
+
+def label_tiles(bboxes, zoom, buffer=0):
+    """ Return a list of (key, number) for the tiles at a zoom touched by each numbered pixel bbox.
+    """
+    return [(tile_key(zoom, col, row), number) for (number, bbox) in enumerate(bboxes)
+            for (col, row) in bbox_tiles(bbox, zoom, buffer)]
+
+def build_tile_lookup(dirname, tiles):
+    """ Write a tile lookup directory from a list of (key, number) for labels in tiles.
+    """
+    keys = sorted(set([key for (key, number) in tiles]))
+
+    # at most half full, so probes stay short
+    bits = max(1, (2 * len(keys)).bit_length())
+    size = 2 ** bits
+
+    table, slots = [EMPTY] * size, {}
+
+    for key in keys:
+        index = slot(key, bits)
+
+        while table[index] != EMPTY:
+            index = (index + 1) & (size - 1)
+
+        table[index], slots[key] = key, index
+
+    # numbers are grouped by slot, and each slot has its start and count
+    tile_slots = array([slots[key] for (key, number) in tiles], dtype=int)
+    numbers = array([number for (key, number) in tiles], dtype=uint32)[argsort(tile_slots, kind='mergesort')]
+
+    counts = bincount(tile_slots, minlength=size).astype(uint32)
+    starts = concatenate(([0], cumsum(counts)[:-1])).astype(uint32)
+
+    temporary = '%s.%d' % (dirname, getpid())
+    makedirs(temporary)
+
+    save(join(temporary, 'keys.npy'), array(table, dtype=uint64))
+    save(join(temporary, 'starts.npy'), starts)
+    save(join(temporary, 'counts.npy'), counts)
+    save(join(temporary, 'numbers.npy'), numbers)
+
+    if exists(dirname):
+        rmtree(dirname)
+
+    rename(temporary, dirname)
+
+class TileLookup:
+    """ Memory-mapped lookup of the labels in each tile, from build_tile_lookup().
+    """
+    def __init__(self, dirname):
+        self._keys = load(join(dirname, 'keys.npy'), mmap_mode='r')
+        self._starts = load(join(dirname, 'starts.npy'), mmap_mode='r')
+        self._counts = load(join(dirname, 'counts.npy'), mmap_mode='r')
+        self._numbers = load(join(dirname, 'numbers.npy'), mmap_mode='r')
+        self._bits = len(self._keys).bit_length() - 1
+
+    def labels(self, zoom, col, row):
+        """ Return an array of the numbers of the labels in a tile, in the order they were added.
+        """
+        key, size = tile_key(zoom, col, row), len(self._keys)
+        index = slot(key, self._bits)
+
+        while int(self._keys[index]) != EMPTY:
+            if int(self._keys[index]) == key:
+                start = self._starts[index]
+                return self._numbers[start:start + self._counts[index]]
+
+            index = (index + 1) & (size - 1)
+
+        return self._numbers[:0]